@@ -4,7 +4,11 @@ import io
 import csv
 import time
 import random
+import base64
+import zlib
+import threading
 import traceback
+import click
 from flask import abort, render_template
 from datetime import date, datetime, timedelta
 from uuid import uuid4
@@ -12,6 +16,7 @@ from functools import wraps
 from pprint import pprint
 from calendar import calendar
 from bson.objectid import ObjectId
+from bson import json_util
 from flask import Response
 # 🔑 LOAD ENV FIRST
 from dotenv import load_dotenv
@@ -20,7 +25,7 @@ load_dotenv()
 from flask import (
     Flask, render_template, request, redirect, url_for,
     flash, send_file, Response, abort, jsonify,
-    session, send_from_directory, g
+    session, send_from_directory, g, stream_with_context, stream_template
 )
 
 from werkzeug.utils import secure_filename
@@ -28,9 +33,9 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 from pymongo import (
     MongoClient, ReturnDocument,
-    ASCENDING, DESCENDING
+    ASCENDING, DESCENDING, UpdateOne, ReplaceOne
 )
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from datetime import datetime, timezone
 datetime.now(timezone.utc)
 
@@ -39,8 +44,15 @@ from bson.errors import InvalidId
 from num2words import num2words
 
 # ❌ REMOVED MONGO_URI FROM config
-from config import UPLOAD_FOLDER, SECRET_KEY, GST_PERCENT
-from utils import get_next_sequence, calc_gst
+from config import UPLOAD_FOLDER, SECRET_KEY, GST_PERCENT, PAGE_SIZE, SEQUENCE_BLOCKS, RECEIPT_GAPFREE
+from utils import get_next_sequence, calc_gst, TTLCache, SequenceAllocator, reserve_sequence
+from indexes import ensure_indexes, index_report
+from search import search_keys, search_filter, rank, PrefixIndex
+from schema import SchemaRegistry
+from refdata import ReferenceCache, CacheSync, log_change, REFERENCE_KINDS
+from studentimport import read_rows, build_student, name_lookup
+from migrations import backfill_student_ids
+from images import PhotoVariants
 from flask import current_app
 
 
@@ -54,6 +66,14 @@ ALLOWED_EXT = {"png", "jpg", "jpeg", "gif"}
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# thumbnail / WebP variants of uploaded photos, built on a background pool (images.py)
+photos = PhotoVariants(UPLOAD_FOLDER, workers=int(os.environ.get("PHOTO_WORKERS", "2")))
+
+@app.template_global()
+def photo_url(filename, size="thumb"):
+    """Static URL of an uploaded photo: its `size` variant once generated, else the original."""
+    return url_for('static', filename='uploads/' + photos.url_path(filename, size))
+
 # ----------------- DATABASE CONNECT (MONGODB ATLAS) -----------------
 MONGO_URI = os.environ.get("MONGO_URI")
 
@@ -77,8 +97,10 @@ courses_col    = db.courses
 payments_col   = db.payments
 faculties_col  = db.faculties
 attendance_col = db.attendance
+sessions_col   = db.attendance_sessions   # one doc per (batch_id, date): {statuses: {student_id: status}}
 salaries_col   = db.salaries
 users_col      = db.users   # IMPORTANT
+accounts_col   = db.student_accounts   # materialized fee/balance per student
 
 # Backwards-compatible aliases
 students  = students_col
@@ -88,6 +110,17 @@ payments  = payments_col
 faculties = faculties_col
 teachers_col = faculties_col
 
+# courses / batches / faculties / ledger_groups served from memory (see refdata.py);
+# CRUD routes call refdata.bump(<collection>) so every worker reloads that kind.
+# Workers on one node share a memory-mapped snapshot file (REFDATA_SNAPSHOT="" to
+# keep a private in-process copy instead). The default lives in the git-ignored
+# Flask instance folder.
+REFDATA_SNAPSHOT = os.environ.get("REFDATA_SNAPSHOT", os.path.join(app.instance_path, "refdata.snapshot"))
+if REFDATA_SNAPSHOT:
+    os.makedirs(os.path.dirname(REFDATA_SNAPSHOT) or ".", exist_ok=True)
+refdata = ReferenceCache(db, check_interval=int(os.environ.get("REFDATA_CHECK_SECONDS", "5")),
+                         snapshot_path=REFDATA_SNAPSHOT or None)
+
 
 
 
@@ -115,23 +148,59 @@ def ensure_default_admin():
         })
         print("Default admin created: username='admin' password='admin123'")
 
+def bootstrap_indexes():
+    """Create the indexes declared in indexes.py (idempotent)."""
+    try:
+        for coll, errs in ensure_indexes(db).items():
+            for err in errs:
+                print(f"❌ Index on {coll} not created:", err)
+    except Exception as e:
+        print("❌ Index bootstrap failed:", e)
+
 # ----------------- RUN ON STARTUP (db already exists ✔) -----------------
 ensure_default_admin()
+if os.environ.get("SKIP_INDEX_BOOTSTRAP") != "1":
+    bootstrap_indexes()
+
+# ----------------- SCHEMA REGISTRY -----------------
+# Collections, indexes and server capabilities, discovered once here and refreshed
+# every SCHEMA_REFRESH_SECONDS in the background, so no route asks the server for
+# metadata (see schema.py).
+schema = SchemaRegistry(client, db).refresh()   # refresh thread: start_worker_threads()
+print("✅ Schema:", len(schema.collections), "collections, capabilities:",
+      ", ".join(k for k, v in schema.capabilities.items() if v is True) or "none")
+
+
+@app.cli.command("schema-info")
+def schema_info_command():
+    """Show the discovered collections, indexes and server capabilities."""
+    for k, v in schema.capabilities.items():
+        print(f"{k}: {v}")
+    for name in sorted(schema.collections):
+        print(f"{name}: {', '.join(sorted(schema.index_names(name)))}")
+
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create all declared indexes and print any that could not be built."""
+    errors = ensure_indexes(db)
+    for coll, errs in errors.items():
+        for err in errs:
+            print(f"{coll}: {err}")
+    print("Indexes ensured." if not errors else "Some indexes could not be created.")
+
+
+@app.cli.command("index-report")
+def index_report_command():
+    """List missing, undeclared and unused indexes per collection."""
+    for coll, info in index_report(db).items():
+        print(f"{coll}: missing={info['missing']} extra={info['extra']} unused={info['unused']}")
 
 # ----------------- OTHER HELPERS BELOW -----------------
 
 def generate_registration_no():
     return f"RKM{random.randint(10000, 99999)}"
 
-def get_next_sequence(db, name):
-    res = db.counters.find_one_and_update(
-        {"_id": name},
-        {"$inc": {"seq": 1}},
-        upsert=True,
-        return_document=ReturnDocument.AFTER
-    )
-    return res["seq"]
-
 def calc_gst(amount, gst_percent):
     gst = round(amount * gst_percent / 100.0, 2)
     total = round(amount + gst, 2)
@@ -146,6 +215,11 @@ def get_next_seq(db, name="institute_db"):
     )
     return int(doc["seq"])
 
+# counters handed out in hi/lo blocks per worker (config.SEQUENCE_BLOCKS);
+# receipt numbers never take blocks while RECEIPT_GAPFREE is on
+sequences = SequenceAllocator(db, {name: size for name, size in SEQUENCE_BLOCKS.items()
+                                   if not (RECEIPT_GAPFREE and name == "receipt_no")})
+
 def get_next_student_id():
     last = students.find_one({"student_id": {"$exists": True}}, sort=[("student_id", -1)])
     if last:
@@ -159,6 +233,87 @@ def month_date_range(year: int, month: int):
     return start, end
 
 
+# ---------- Keyset (cursor) pagination ----------
+# Pages are ordered by (field desc, _id desc). A cursor token is the url-safe
+# base64 of [field value, _id] of a boundary row; "after" moves to older rows,
+# "before" to newer ones. Rows with a missing/null field sort last.
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(doc, field):
+    raw = json_util.dumps([doc.get(field), doc["_id"]])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+CURSOR_VALUE_TYPES = (datetime, int, float, str, type(None))
+
+def decode_cursor(token):
+    """[field value, _id] from a token; ValueError unless it is a scalar and an ObjectId."""
+    raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    decoded = json_util.loads(raw)
+    if not isinstance(decoded, list) or len(decoded) != 2:
+        raise ValueError("malformed cursor")
+    value, oid = decoded
+    # only plain values go into the filter: a dict here would be a query operator
+    if not isinstance(value, CURSOR_VALUE_TYPES) or not isinstance(oid, ObjectId):
+        raise ValueError("malformed cursor")
+    return value, oid
+
+def keyset_args(default_size=PAGE_SIZE):
+    """(after, before, per_page) from the request args; bad tokens fall back to page one."""
+    after = request.args.get('after') or None
+    before = request.args.get('before') or None
+    for token in (after, before):
+        if token:
+            try:
+                decode_cursor(token)
+            except Exception:
+                after = before = None
+    try:
+        per_page = int(request.args.get('per_page', default_size))
+    except ValueError:
+        per_page = default_size
+    return after, before, min(max(per_page, 1), MAX_PAGE_SIZE)
+
+def keyset_filter(field, token, backward=False):
+    value, oid = decode_cursor(token)
+    op = "$gt" if backward else "$lt"
+    if value is None:
+        tie = {field: None, "_id": {op: oid}}
+        return {"$or": [{field: {"$ne": None}}, tie]} if backward else tie
+    clauses = [{field: {op: value}}, {field: value, "_id": {op: oid}}]
+    if not backward:
+        clauses.append({field: None})
+    return {"$or": clauses}
+
+def keyset_query(query, field, after=None, before=None):
+    """query restricted to the rows after/before the given cursor."""
+    token = before or after
+    if not token:
+        return query or {}
+    cond = keyset_filter(field, token, backward=bool(before))
+    return {"$and": [query, cond]} if query else cond
+
+def keyset_sort(field, before=None):
+    direction = ASCENDING if before else DESCENDING
+    return [(field, direction), ("_id", direction)]
+
+def keyset_page(docs, field, per_page, after=None, before=None):
+    """
+    Trim a per_page + 1 fetch to one page and build the neighbour tokens.
+    Returns (docs, next_token, prev_token).
+    """
+    docs = list(docs)
+    has_more = len(docs) > per_page
+    docs = docs[:per_page]
+    if before:
+        docs.reverse()
+        next_token = encode_cursor(docs[-1], field) if docs else None
+        prev_token = encode_cursor(docs[0], field) if docs and has_more else None
+    else:
+        next_token = encode_cursor(docs[-1], field) if docs and has_more else None
+        prev_token = encode_cursor(docs[0], field) if docs and after else None
+    return docs, next_token, prev_token
+
+
 
 
 def login_required(f):
@@ -175,10 +330,183 @@ def login_required(f):
 # _____________ALL ROUTES_________________
 
 
+# ---------- Year / month rollups ----------
+# One rollups document per calendar month (_id "YYYY-MM") holding admissions,
+# collections, gst, attendance_present / attendance_marked and salaries. Student,
+# payment and attendance writes $inc it; salary writes recompute their month
+# (salary upserts replace amounts); rebuild_rollups() regenerates everything.
+rollups_col = db.rollups
+ROLLUP_FIELDS = ("admissions", "collections", "gst", "attendance_present",
+                 "attendance_marked", "salaries")
+
+
+def month_of(value):
+    """(year, month) of a datetime or 'YYYY-MM...' string; None if unparseable."""
+    if isinstance(value, datetime):
+        return value.year, value.month
+    try:
+        year, month = str(value)[:7].split("-")
+        return int(year), int(month)
+    except Exception:
+        return None
+
+
+def bump_rollup(when, **inc):
+    """Add the given deltas to the month containing `when`."""
+    ym = month_of(when)
+    inc = {k: v for k, v in inc.items() if v}
+    if not ym or not inc:
+        return
+    year, month = ym
+    rollups_col.update_one({"_id": f"{year}-{month:02d}"}, {
+        "$inc": inc,
+        "$set": {"year": year, "month": month, "updated_at": datetime.utcnow()}
+    }, upsert=True)
+
+
+SALARY_PAID_EXPR = {"$ifNull": ["$gross", {"$ifNull": ["$amount", 0]}]}  # days mode stores gross
+
+def refresh_salary_rollup(year, month):
+    """Recompute one month's salaries total (salary docs are upserted, not appended)."""
+    try:
+        year, month = int(year), int(month)
+    except (TypeError, ValueError):
+        return
+    total = next(db.salaries.aggregate([
+        {"$match": {"year": year, "month": month}},
+        {"$group": {"_id": None, "total": {"$sum": SALARY_PAID_EXPR}}}
+    ]), {}).get("total", 0)
+    rollups_col.update_one({"_id": f"{year}-{month:02d}"}, {
+        "$set": {"year": year, "month": month, "salaries": round(total, 2),
+                 "updated_at": datetime.utcnow()}
+    }, upsert=True)
+
+
+def month_expr(field):
+    """'YYYY-MM' for a date field that may hold a datetime or a date string."""
+    return {"$cond": [
+        {"$eq": [{"$type": field}, "date"]},
+        {"$dateToString": {"format": "%Y-%m", "date": field}},
+        {"$substr": [{"$ifNull": [field, ""]}, 0, 7]}
+    ]}
+
+
+def rebuild_rollups():
+    """Regenerate every month's rollup from students, payments, attendance and salaries."""
+    months = {}
+
+    def add(rows):
+        for r in rows:
+            if month_of(r["_id"]):
+                months.setdefault(r["_id"], {}).update({k: v for k, v in r.items() if k != "_id"})
+
+    add(db.students.aggregate([
+        {"$group": {"_id": month_expr("$created_at"), "admissions": {"$sum": 1}}}
+    ]))
+    add(db.payments.aggregate([
+        {"$group": {"_id": month_expr("$date"),
+                    "collections": {"$sum": {"$ifNull": ["$amount", 0]}},
+                    "gst": {"$sum": {"$ifNull": ["$gst", 0]}}}}
+    ]))
+    add(sessions_col.aggregate([
+        {"$project": {"date": 1, "s": {"$objectToArray": {"$ifNull": ["$statuses", {}]}}}},
+        {"$unwind": "$s"},
+        {"$group": {"_id": {"$substr": ["$date", 0, 7]},
+                    "attendance_present": {"$sum": {"$cond": [{"$eq": ["$s.v", "present"]}, 1, 0]}},
+                    "attendance_marked": {"$sum": 1}}}
+    ], allowDiskUse=True))
+    add(db.salaries.aggregate([
+        {"$match": {"year": {"$type": "number"}, "month": {"$type": "number"}}},
+        {"$group": {"_id": {"year": "$year", "month": "$month"}, "salaries": {"$sum": SALARY_PAID_EXPR}}},
+        {"$project": {"_id": {"$concat": [
+            {"$toString": "$_id.year"}, "-",
+            {"$cond": [{"$lt": ["$_id.month", 10]}, "0", ""]}, {"$toString": "$_id.month"}]},
+            "salaries": 1}}
+    ]))
+
+    now = datetime.utcnow()
+    ops = []
+    for key, vals in months.items():
+        year, month = month_of(key)
+        doc = {f: 0 for f in ROLLUP_FIELDS}
+        doc.update(vals)
+        doc.update({"year": year, "month": month, "updated_at": now})
+        ops.append(ReplaceOne({"_id": key}, doc, upsert=True))
+    if ops:
+        rollups_col.bulk_write(ops, ordered=False)
+    rollups_col.delete_many({"_id": {"$nin": list(months)}})
+    db.migrations.update_one({"_id": "rollups"},
+                             {"$set": {"state": "done", "updated_at": now}}, upsert=True)
+    return len(months)
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Regenerate the per-month rollups used by /dashboard/years."""
+    print("rollups rebuilt:", rebuild_rollups(), "months")
+
+
+def bootstrap_rollups():
+    """
+    Writes only keep existing rollups current, so build them from the raw
+    collections once per database (marked in db.migrations).
+    """
+    try:
+        if db.migrations.find_one({"_id": "rollups", "state": "done"}):
+            return
+        print("✅ rollups built:", rebuild_rollups(), "months")
+    except Exception as e:
+        print("❌ rollups build failed:", e)
+
+bootstrap_rollups()
+
+
 @app.route('/dashboard/years')
+@login_required
 def years_dashboard():
-    # build 'years' from your DB (group by year)
-    return render_template('year_dashboard.html', years=years)
+    # trend figures come from the month rollups (at most 12 small docs per year)
+    years = {}
+    for r in rollups_col.find().sort("_id", 1):
+        y = years.setdefault(r["year"], {"year": r["year"], "months": [], "batches": [], "students": []})
+        present, marked = r.get("attendance_present", 0), r.get("attendance_marked", 0)
+        y["months"].append({
+            "label": date(r["year"], r["month"], 1).strftime("%b"),
+            "admissions": r.get("admissions", 0),
+            "collections": r.get("collections", 0),
+            "gst": r.get("gst", 0),
+            "attendance_pct": round(100.0 * present / marked, 1) if marked else None,
+            "salaries": r.get("salaries", 0),
+        })
+
+    # per-batch student counts and collections from the student_accounts read model
+    per_batch = {row["_id"]: row for row in accounts_col.aggregate([
+        {"$group": {"_id": "$batch_id", "student_count": {"$sum": 1}, "collected": {"$sum": "$paid"}}}
+    ])}
+    for b in refdata.all("batches"):
+        ym = month_of(b.get("start_date") or b.get("created_at"))
+        if not ym:
+            continue
+        y = years.setdefault(ym[0], {"year": ym[0], "months": [], "batches": [], "students": []})
+        stats = per_batch.get(b["_id"], {})
+        y["batches"].append({
+            "_id": str(b["_id"]),
+            "name": b.get("title") or b.get("name", ""),
+            "course": b.get("course", ""),
+            "start_date": b.get("start_date", ""),
+            "student_count": stats.get("student_count", 0),
+            "collected": stats.get("collected", 0),
+        })
+
+    for y in years.values():
+        y["total_students"] = sum(m["admissions"] for m in y["months"])
+        y["total_amount"] = sum(m["collections"] for m in y["months"])
+        y["total_batches"] = len(y["batches"])
+        y["students"] = list(db.students.find(
+            {"created_at": {"$gte": datetime(y["year"], 1, 1), "$lt": datetime(y["year"] + 1, 1, 1)}},
+            {"first_name": 1, "last_name": 1, "phone": 1, "photo": 1}
+        ).sort("created_at", -1).limit(8))
+
+    return render_template('year_dashboard.html', years=sorted(years.values(), key=lambda y: y["year"], reverse=True))
 
 
 
@@ -194,81 +522,202 @@ def num2words_filter(num, lang='en_IN'):
 
 
 # ---------- Home / Statistics ----------
+DASHBOARD_TTL = int(os.environ.get("DASHBOARD_TTL", "60"))
+dashboard_cache = TTLCache(DASHBOARD_TTL)   # invalidated by student / batch writes
+
+def dashboard_stats():
+    """All home-page statistics from one $facet aggregation over students."""
+    def per(field, coll, name_key, out_id, out_name):
+        return [
+            {"$group": {"_id": field, "count": {"$sum": 1}}},
+            {"$lookup": {"from": coll, "localField": "_id", "foreignField": "_id", "as": "ref"}},
+            {"$unwind": {"path": "$ref", "preserveNullAndEmptyArrays": True}},
+            {"$project": {
+                "_id": 0,
+                out_id: "$_id",
+                out_name: {"$ifNull": [name_key, "(Unassigned)"]},
+                "count": 1
+            }},
+            {"$sort": {"count": -1}}
+        ]
+
+    pipeline = [{"$facet": {
+        "student_count": [{"$count": "n"}],
+        "gender": [{"$group": {"_id": "$gender", "n": {"$sum": 1}}}],
+        "batch_count": [
+            {"$limit": 1},
+            {"$lookup": {"from": "batches", "pipeline": [{"$count": "n"}], "as": "b"}},
+            {"$project": {"n": {"$ifNull": [{"$arrayElemAt": ["$b.n", 0]}, 0]}}}
+        ],
+        # batch-wise gender breakdown
+        "batch_stats": [
+            {"$group": {
+                "_id": "$batch_id",
+                "boys": {"$sum": {"$cond": [{"$eq": ["$gender", "Male"]}, 1, 0]}},
+                "girls": {"$sum": {"$cond": [{"$eq": ["$gender", "Female"]}, 1, 0]}},
+                "total": {"$sum": 1}
+            }},
+            {"$lookup": {"from": "batches", "localField": "_id", "foreignField": "_id", "as": "batch"}},
+            {"$unwind": {"path": "$batch", "preserveNullAndEmptyArrays": True}},
+            {"$group": {
+                "_id": "$batch.title",
+                "boys": {"$sum": "$boys"},
+                "girls": {"$sum": "$girls"},
+                "total": {"$sum": "$total"}
+            }},
+            {"$sort": {"_id": 1}}
+        ],
+        # faculty_id may be ObjectId or string; attach faculty name if present
+        "by_faculty": per("$faculty_id", "faculties", "$ref.name", "faculty_id", "faculty_name"),
+        "by_course": per("$course_id", "courses", "$ref.name", "course_id", "course_name"),
+    }}]
+    res = list(db.students.aggregate(pipeline))[0]
+
+    genders = {g["_id"]: g["n"] for g in res["gender"]}
+    student_count = res["student_count"][0]["n"] if res["student_count"] else 0
+    if res["batch_count"]:
+        batch_count = res["batch_count"][0]["n"]
+    else:
+        batch_count = db.batches.count_documents({})   # no students yet
+    return {
+        "batch_count": batch_count,
+        "student_count": student_count,
+        "male": genders.get("Male", 0),
+        "female": genders.get("Female", 0),
+        "batch_stats": res["batch_stats"],
+        "by_faculty": res["by_faculty"],
+        "by_course": res["by_course"],
+    }
+
+
 @app.route('/')
 @login_required
 def index():
-    # basic totals
-    batch_count = db.batches.count_documents({})
-    student_count = db.students.count_documents({})
-    male = db.students.count_documents({"gender": "Male"})
-    female = db.students.count_documents({"gender": "Female"})
+    # one round trip (or none while cached); ?fresh=1 bypasses the cache
+    stats = None if request.args.get('fresh') == '1' else dashboard_cache.get("stats")
+    if stats is None:
+        stats = dashboard_cache.set("stats", dashboard_stats())
 
-    # batch-wise gender breakdown (your existing pipeline)
-    pipeline = [
-        {"$lookup": {"from": "batches", "localField": "batch_id", "foreignField": "_id", "as": "batch"}},
-        {"$unwind": {"path": "$batch", "preserveNullAndEmptyArrays": True}},
-        {"$group": {
-            "_id": "$batch.title",
-            "boys": {"$sum": {"$cond": [{"$eq": ["$gender", "Male"]}, 1, 0]}},
-            "girls": {"$sum": {"$cond": [{"$eq": ["$gender", "Female"]}, 1, 0]}},
-            "total": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    batch_stats = list(db.students.aggregate(pipeline))
-
-    # ---------- Students per Faculty ----------
-    # Group students by faculty_id (may be ObjectId or string), attach faculty name if present
-    faculty_pipeline = [
-        {"$group": {"_id": "$faculty_id", "count": {"$sum": 1}}},
-        {"$lookup": {"from": "faculties", "localField": "_id", "foreignField": "_id", "as": "faculty"}},
-        {"$unwind": {"path": "$faculty", "preserveNullAndEmptyArrays": True}},
-        {"$project": {
-            "_id": 0,
-            "faculty_id": "$_id",
-            "faculty_name": {"$ifNull": ["$faculty.name", "(Unassigned)"]},
-            "count": 1
-        }},
-        {"$sort": {"count": -1}}
-    ]
-    by_faculty = list(db.students.aggregate(faculty_pipeline))
+    # Render template with all statistics
+    return render_template('index.html', **stats)
 
-    # ---------- Students per Course ----------
-    course_pipeline = [
-        {"$group": {"_id": "$course_id", "count": {"$sum": 1}}},
-        {"$lookup": {"from": "courses", "localField": "_id", "foreignField": "_id", "as": "course"}},
-        {"$unwind": {"path": "$course", "preserveNullAndEmptyArrays": True}},
-        {"$project": {
-            "_id": 0,
-            "course_id": "$_id",
-            "course_name": {"$ifNull": ["$course.name", "(Unassigned)"]},
-            "count": 1
-        }},
-        {"$sort": {"count": -1}}
-    ]
-    by_course = list(db.students.aggregate(course_pipeline))
 
-    # Render template with all statistics
-    return render_template(
-        'index.html',
-        batch_count=batch_count,
-        student_count=student_count,
-        male=male,
-        female=female,
-        batch_stats=batch_stats,
-        by_faculty=by_faculty,
-        by_course=by_course
-    )
 
 
 
+# ---------- Expiry date (typed, written at write time) ----------
+# students.expiry_date is stored as a datetime = admission_date + duration, where the
+# duration comes from the batch first, then the course (duration_days / duration /
+# duration_months; "6 months" style strings count 30 days per month).
+
+def parse_duration_days(doc):
+    if not doc:
+        return None
+    dur = doc.get("duration_days") or doc.get("duration")
+    if not dur and doc.get("duration_months"):
+        try:
+            return int(doc["duration_months"]) * 30
+        except (TypeError, ValueError):
+            return None
+    if not dur:
+        return None
+    if isinstance(dur, str):
+        digits = ''.join(ch for ch in dur if ch.isdigit())
+        if not digits:
+            return None
+        return int(digits) * 30 if "month" in dur.lower() else int(digits)
+    try:
+        return int(dur)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_any_date(value):
+    """datetime from a datetime or a 'YYYY-MM-DD' / 'DD-MM-YYYY' string (None if unparseable)."""
+    if isinstance(value, datetime):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if isinstance(value, str) and value:
+        for fmt in ("%Y-%m-%d", "%d-%m-%Y"):
+            try:
+                return datetime.strptime(value[:10], fmt)
+            except ValueError:
+                pass
+    return None
+
+
+def compute_expiry_date(student, batch=None, course=None):
+    """admission_date + batch/course duration as a datetime, else the stored expiry (typed).
+    Older records keep it in `expiry` instead of `expiry_date`."""
+    admission = parse_any_date(student.get("admission_date"))
+    days = parse_duration_days(batch)
+    if days is None:
+        days = parse_duration_days(course)
+    if admission and days:
+        return admission + timedelta(days=days)
+    return parse_any_date(student.get("expiry_date") or student.get("expiry"))
+
+
+def refresh_expiry_dates(query, chunk_size=1000):
+    """Recompute students.expiry_date for students matching query; returns docs updated."""
+    fields = {"admission_date": 1, "expiry_date": 1, "expiry": 1, "batch_id": 1, "course_id": 1}
+
+    updated = 0
+    ops = []
+    for s in students_col.find(query, fields):
+        expiry = compute_expiry_date(s, refdata.get("batches", s.get("batch_id")),
+                                     refdata.get("courses", s.get("course_id")))
+        if expiry == s.get("expiry_date"):
+            continue
+        if expiry is None:
+            ops.append(UpdateOne({"_id": s["_id"]}, {"$unset": {"expiry_date": ""}}))
+        else:
+            ops.append(UpdateOne({"_id": s["_id"]}, {"$set": {"expiry_date": expiry}}))
+        if len(ops) >= chunk_size:
+            updated += students_col.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += students_col.bulk_write(ops, ordered=False).modified_count
+    return updated
+
+
+@app.cli.command("backfill-expiry")
+def backfill_expiry_command():
+    """Write a typed expiry_date on every student (admission_date + duration)."""
+    n = refresh_expiry_dates({})
+    db.migrations.update_one({"_id": "expiry_date"},
+                             {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+    print("expiry_date updated on", n, "students")
+
+
+def bootstrap_expiry_dates():
+    """
+    The notification queries range over the typed expiry_date, so write it on
+    students saved before it existed, once per database (marked in db.migrations).
+    """
+    try:
+        if db.migrations.find_one({"_id": "expiry_date", "state": "done"}):
+            return
+        n = refresh_expiry_dates({})
+        db.migrations.update_one({"_id": "expiry_date"},
+                                 {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+        print("✅ expiry_date backfilled on", n, "students")
+    except Exception as e:
+        print("❌ expiry_date backfill failed:", e)
+
+bootstrap_expiry_dates()
+
+
+def optional_int(value):
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
 
 
 # ---------- Batches ----------
 @app.route('/batches')
 def batches_list():
-    batches = list(db.batches.find().sort("start_date", -1))
-    return render_template('batches_list.html', batches=batches)
+    return render_template('batches_list.html', batches=refdata.all("batches"))
 
 @app.route('/batch/add', methods=['GET','POST'])
 def add_batch():
@@ -280,7 +729,12 @@ def add_batch():
             "start_date": start_date,
             "created_at": datetime.utcnow()
         }
+        duration_days = optional_int(request.form.get('duration_days'))
+        if duration_days:
+            doc["duration_days"] = duration_days
         db.batches.insert_one(doc)
+        refdata.bump("batches")
+        dashboard_cache.invalidate()
         flash("Batch added.")
         return redirect(url_for('batches_list'))
     return render_template('batch_form.html')
@@ -289,8 +743,14 @@ def add_batch():
 def edit_batch(bid):
     batch = db.batches.find_one({"_id": ObjectId(bid)})
     if request.method == 'POST':
-        db.batches.update_one({"_id": ObjectId(bid)},
-                              {"$set": {"title": request.form['title'], "start_date": request.form['start_date']}})
+        fields = {"title": request.form['title'], "start_date": request.form['start_date']}
+        duration_days = optional_int(request.form.get('duration_days'))
+        if duration_days is not None:
+            fields["duration_days"] = duration_days
+        db.batches.update_one({"_id": ObjectId(bid)}, {"$set": fields})
+        refdata.bump("batches")
+        if duration_days is not None and duration_days != parse_duration_days(batch):
+            refresh_expiry_dates({"batch_id": ObjectId(bid)})
         flash("Batch updated.")
         return redirect(url_for('batches_list'))
     return render_template('batch_form.html', batch=batch)
@@ -298,6 +758,8 @@ def edit_batch(bid):
 @app.route('/batch/delete/<bid>', methods=['POST'])
 def delete_batch(bid):
     db.batches.delete_one({"_id": ObjectId(bid)})
+    refdata.bump("batches")
+    dashboard_cache.invalidate()
     flash("Batch deleted.")
     return redirect(url_for('batches_list'))
 
@@ -307,15 +769,19 @@ def delete_batch(bid):
 # ---------- Courses ----------
 @app.route('/courses')
 def courses_list():
-    courses = list(db.courses.find().sort("name", 1))
-    return render_template('courses_list.html', courses=courses)
+    return render_template('courses_list.html', courses=refdata.all("courses"))
 
 @app.route('/course/add', methods=['GET','POST'])
 def add_course():
     if request.method == 'POST':
         name = request.form['name']
         fee = float(request.form['fee'] or 0)
-        db.courses.insert_one({"name": name, "fee": fee})
+        doc = {"name": name, "fee": fee}
+        duration_days = optional_int(request.form.get('duration_days'))
+        if duration_days:
+            doc["duration_days"] = duration_days
+        db.courses.insert_one(doc)
+        refdata.bump("courses")
         flash("Course added.")
         return redirect(url_for('courses_list'))
     return render_template('course_form.html')
@@ -324,68 +790,165 @@ def add_course():
 def edit_course(cid):
     course = db.courses.find_one({"_id": ObjectId(cid)})
     if request.method == 'POST':
-        db.courses.update_one({"_id": ObjectId(cid)}, {"$set": {"name": request.form['name'], "fee": float(request.form['fee'])}})
+        fields = {"name": request.form['name'], "fee": float(request.form['fee'])}
+        duration_days = optional_int(request.form.get('duration_days'))
+        if duration_days is not None:
+            fields["duration_days"] = duration_days
+        db.courses.update_one({"_id": ObjectId(cid)}, {"$set": fields})
+        refdata.bump("courses")
+        reprice_course_accounts(ObjectId(cid), float(request.form['fee']))
+        if duration_days is not None and duration_days != parse_duration_days(course):
+            refresh_expiry_dates({"course_id": ObjectId(cid)})
         return redirect(url_for('courses_list'))
     return render_template('course_form.html', course=course)
 
 @app.route('/course/delete/<cid>', methods=['POST'])
 def delete_course(cid):
     db.courses.delete_one({"_id": ObjectId(cid)})
+    refdata.bump("courses")
     flash("Course deleted.")
     return redirect(url_for('courses_list'))
 
 
+# ---------- Student search keys (see search.py) ----------
+# Per-worker autocomplete index, warmed in the background on the worker's first
+# request and kept in sync by add/edit/delete student; /api/all_students uses
+# Mongo until it is ready.
+student_index = PrefixIndex()
+
+def warm_student_index():
+    try:
+        student_index.load(students_col.find({}, PrefixIndex.FIELDS))
+    except Exception as e:
+        print("❌ Student autocomplete index warm-up failed:", e)
+
+
+# ---------- Cross-worker cache sync ----------
+# Each worker tails one change stream: cache_versions bumps move refdata to the
+# new version, student writes update student_index and clear the dashboard stats.
+# On a standalone mongod without change streams it polls cache_versions instead and
+# applies the _ids every student write logs in cache_changes (any worker may be
+# polling, so writes always log). Stream support is re-checked as the schema
+# registry refreshes.
+CACHE_SYNC_SECONDS = int(os.environ.get("CACHE_SYNC_SECONDS", "5"))
+
+def students_changed(ids=None):
+    """Call after any student write with the touched _ids (None: unknown, others reload)."""
+    dashboard_cache.invalidate()
+    log_change(db, "students", ids)
+
+
+def sync_reference(kind):
+    def handler(version):
+        refdata.evict(kind, version)
+        if kind == "batches":
+            dashboard_cache.invalidate()
+    return handler
+
+
+def sync_students(change):
+    dashboard_cache.invalidate()
+    if change is None:
+        # polling fallback without a usable change log: rebuild the autocomplete index
+        student_index.reload(students_col.find({}, PrefixIndex.FIELDS))
+    elif change["operationType"] == "changed":
+        # polling fallback: re-read just the logged students
+        found = {d["_id"]: d for d in students_col.find({"_id": {"$in": change["ids"]}}, PrefixIndex.FIELDS)}
+        for sid in change["ids"]:
+            if sid in found:
+                student_index.upsert(found[sid])
+            else:
+                student_index.remove(sid)
+    elif change["operationType"] == "delete":
+        student_index.remove(change["documentKey"]["_id"])
+    elif change.get("fullDocument"):
+        student_index.upsert(change["fullDocument"])
+
+
+cache_sync = CacheSync(
+    db,
+    versions={kind: sync_reference(kind) for kind in REFERENCE_KINDS},
+    collections={"students": sync_students},
+    poll_interval=CACHE_SYNC_SECONDS,
+    streams=lambda: schema.supports("change_streams"),
+    on_mode=lambda mode: print("🔄 Cache sync mode:", mode),
+)
+# started per worker by start_worker_threads(), once the users handler is registered too
+
+@app.cli.command("backfill-student-ids")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--restart", is_flag=True, help="Forget the checkpoint and run again from the start.")
+def backfill_student_ids_command(batch_size, restart):
+    """Assign student_id to students missing one; resumes after an interruption."""
+    state = backfill_student_ids(db, batch_size=batch_size, restart=restart)
+    data = state.get("data") or {}
+    print(f"student_id backfill {state['state']}: {state['position']} students, "
+          f"ids {data.get('first')}..{data.get('last')}")
+    if state.get("remaining"):
+        print(state["remaining"], "students still have no student_id; run again with --restart")
+    students_changed()
+
+
+def backfill_search_keys():
+    """(Re)write the normalized search keys on every student; returns how many changed."""
+    fields = {"first_name": 1, "last_name": 1, "father_name": 1, "phone": 1,
+              "parents_phone": 1, "aadhar": 1, "form_no": 1, "search": 1}
+    ops, updated = [], 0
+    for s in students_col.find({}, fields):
+        keys = search_keys(s)
+        if keys != s.get("search"):
+            ops.append(UpdateOne({"_id": s["_id"]}, {"$set": {"search": keys}}))
+        if len(ops) >= 1000:
+            updated += students_col.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += students_col.bulk_write(ops, ordered=False).modified_count
+    db.migrations.update_one({"_id": "search_keys"},
+                             {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+    return updated
+
+
+@app.cli.command("backfill-search")
+def backfill_search_command():
+    """(Re)write the normalized search keys on every student."""
+    print("search keys updated on", backfill_search_keys(), "students")
+
+
+def bootstrap_search_keys():
+    """
+    Search only matches the stored `search` keys, so students saved before they
+    existed are unfindable until backfilled. Done once per database, marked in
+    db.migrations like student_accounts.
+    """
+    try:
+        if db.migrations.find_one({"_id": "search_keys", "state": "done"}):
+            return
+        print("✅ search keys backfilled on", backfill_search_keys(), "students")
+    except Exception as e:
+        print("❌ search keys backfill failed:", e)
+
+bootstrap_search_keys()
+
+
 @app.route('/students')
 def students_list():
     q = request.args.get('q','').strip()
     query = {}
     if q:
-        query = {"$or":[
-            {"first_name":{"$regex": q, "$options":"i"}},
-            {"last_name":{"$regex": q, "$options":"i"}},
-            {"phone":{"$regex": q}},
-            {"form_no":{"$regex": q}},
-            {"aadhar":{"$regex": q}}
-        ]}
-
-    # fetch students (limited)
-    students = list(db.students.find(query).sort("created_at",-1).limit(200))
-
-    # Prefetch lookup maps to avoid N queries
-    course_ids = {s.get('course_id') for s in students if s.get('course_id')}
-    batch_ids = {s.get('batch_id') for s in students if s.get('batch_id')}
-    faculty_ids = {s.get('faculty_id') for s in students if s.get('faculty_id')}
-
-    # convert any ObjectId in sets to ObjectId type for queries (if stored as string)
-    def norm_ids(idset):
-        out = []
-        for i in idset:
-            if not i:
-                continue
-            try:
-                out.append(ObjectId(i) if not isinstance(i, ObjectId) else i)
-            except Exception:
-                # skip invalid ids (they might be actual string names)
-                pass
-        return out
-
-    course_map = {}
-    if course_ids:
-        rows = db.courses.find({"_id": {"$in": norm_ids(course_ids)}})
-        for r in rows:
-            course_map[str(r['_id'])] = r.get('name') or r.get('title') or ''
+        # indexed name-prefix / number-suffix match on the search keys
+        query = search_filter(q)
 
-    batch_map = {}
-    if batch_ids:
-        rows = db.batches.find({"_id": {"$in": norm_ids(batch_ids)}})
-        for r in rows:
-            batch_map[str(r['_id'])] = r.get('name') or r.get('title') or ''
+    # fetch one keyset page of students (newest first)
+    after, before, per_page = keyset_args()
+    cursor = (db.students.find(keyset_query(query, "created_at", after, before))
+              .sort(keyset_sort("created_at", before))
+              .limit(per_page + 1))
+    students, next_token, prev_token = keyset_page(cursor, "created_at", per_page, after, before)
 
-    faculty_map = {}
-    if faculty_ids:
-        rows = db.faculties.find({"_id": {"$in": norm_ids(faculty_ids)}})
-        for r in rows:
-            faculty_map[str(r['_id'])] = r.get('name') or r.get('title') or ''
+    # id -> name maps come from the in-memory reference cache
+    course_map = refdata.names("courses")
+    batch_map = refdata.names("batches")
+    faculty_map = refdata.names("faculties")
 
     # Enrich students for template (and normalise field names)
     enriched = []
@@ -434,24 +997,27 @@ def students_list():
         enriched.append(st)
 
     # pass lists for filters too (if template uses them)
-    courses = list(db.courses.find().sort("name", 1))
-    batches = list(db.batches.find().sort("start_date", -1))
-    faculties = list(db.faculties.find())
+    courses = refdata.all("courses")
+    batches = refdata.all("batches")
+    faculties = refdata.all("faculties")
 
     return render_template('students_list.html',
                            students=enriched,
                            batches=batches,
                            courses=courses,
                            faculties=faculties,
-                           q=q)
+                           q=q,
+                           per_page=per_page,
+                           next_token=next_token,
+                           prev_token=prev_token)
 
 
 
 @app.route('/student/add', methods=['GET','POST'])
 def add_student():
-    batches = list(db.batches.find())
-    courses = list(db.courses.find())
-    faculties = list(db.faculties.find()) if 'faculties' in db.list_collection_names() else []
+    batches = refdata.all("batches")
+    courses = refdata.all("courses")
+    faculties = refdata.all("faculties")
 
     if request.method == 'POST':
         # --- TAKE form_no FROM USER (manual entry) ---
@@ -489,6 +1055,7 @@ def add_student():
             "blood_group": request.form.get('blood_group',''),
             "created_at": datetime.utcnow()
         }
+        data['search'] = search_keys(data)
 
         # batch_id (try to convert to ObjectId; else store None)
         if request.form.get('batch_id'):
@@ -511,7 +1078,7 @@ def add_student():
             try:
                 fid = ObjectId(faculty_id_raw)
                 data['faculty_id'] = fid
-                fdoc = db.faculties.find_one({"_id": fid})
+                fdoc = refdata.get("faculties", fid)
                 if fdoc and fdoc.get('name'):
                     faculty_name = fdoc['name']
             except Exception:
@@ -528,9 +1095,10 @@ def add_student():
             os.makedirs(os.path.dirname(path), exist_ok=True)
             photo.save(path)
             data['photo'] = unique_fname
+            photos.submit(unique_fname)
 
         # generate student_id (sequence)
-        data['student_id'] = get_next_seq(db, "student_id")
+        data['student_id'] = int(sequences.next("student_id"))
 
         # Defensive: ensure we don't accidentally try to insert a pre-existing _id
         data.pop('_id', None)
@@ -549,6 +1117,12 @@ def add_student():
             flash("An unexpected error occurred while registering the student.", "danger")
             return redirect(url_for('add_student'))
 
+        refresh_student_account(data)
+        refresh_expiry_dates({"_id": res.inserted_id})
+        bump_rollup(data["created_at"], admissions=1)
+        student_index.upsert(data)
+        students_changed([res.inserted_id])
+
         flash("Student registered.", "success")
         return redirect(url_for('students_list'))
 
@@ -556,10 +1130,145 @@ def add_student():
     return render_template('student_form.html', batches=batches, courses=courses, faculties=faculties)
 
 
+# ---------- Bulk student import ----------
+# Rows are validated IMPORT_CHUNK at a time: one $in query for taken form numbers,
+# one counter update for the chunk's student_ids, one insert_many, one bulk write
+# of accounts. Names are resolved against refdata, so no per-row lookups.
+IMPORT_CHUNK = int(os.environ.get("IMPORT_CHUNK", "500"))
+
+def import_students(rows, dry_run=False):
+    """
+    Import (line_no, row) pairs from studentimport.read_rows().
+    Returns {"rows", "valid", "inserted", "errors": [(line_no, form_no, message)]};
+    with dry_run nothing is written and "valid" counts the rows that would be.
+    """
+    refs = {}
+    for kind in ("courses", "batches", "faculties"):
+        names = refdata.names(kind)
+        refs[kind] = (name_lookup(names), names)
+    report = {"rows": 0, "valid": 0, "inserted": 0, "errors": []}
+    seen = set()
+    chunk = []
+    for line_no, row in rows:
+        report["rows"] += 1
+        chunk.append((line_no, row))
+        if len(chunk) >= IMPORT_CHUNK:
+            import_chunk(chunk, refs, seen, report, dry_run)
+            chunk = []
+    if chunk:
+        import_chunk(chunk, refs, seen, report, dry_run)
+    report["errors"].sort(key=lambda e: e[0])
+    return report
+
+
+def import_chunk(chunk, refs, seen, report, dry_run):
+    valid = []
+    for line_no, row in chunk:
+        doc, errors = build_student(row, refs)
+        form_no = doc["form_no"]
+        if form_no in seen:
+            errors.append(f"form_no {form_no} appears earlier in the file")
+        elif form_no:
+            seen.add(form_no)
+        if errors:
+            report["errors"].append((line_no, form_no, "; ".join(errors)))
+        else:
+            valid.append((line_no, doc))
+
+    taken = {s["form_no"] for s in students_col.find(
+        {"form_no": {"$in": [doc["form_no"] for _, doc in valid]}}, {"form_no": 1})}
+    if taken:
+        for line_no, doc in valid:
+            if doc["form_no"] in taken:
+                report["errors"].append((line_no, doc["form_no"], "form_no already exists"))
+        valid = [(line_no, doc) for line_no, doc in valid if doc["form_no"] not in taken]
+    report["valid"] += len(valid)
+    if dry_run or not valid:
+        return
+
+    first, _ = reserve_sequence(db, "student_id", len(valid))
+    now = datetime.utcnow()
+    docs = []
+    for i, (_, doc) in enumerate(valid):
+        doc["student_id"] = first + i
+        doc["registration_no"] = generate_registration_no()
+        doc["created_at"] = now
+        doc["search"] = search_keys(doc)
+        expiry = compute_expiry_date(doc, refdata.get("batches", doc.get("batch_id")),
+                                     refdata.get("courses", doc.get("course_id")))
+        if expiry:
+            doc["expiry_date"] = expiry
+        docs.append(doc)
+
+    failed = set()
+    try:
+        students_col.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # e.g. a form_no registered by someone else since the check above
+        for err in e.details.get("writeErrors", []):
+            failed.add(err["index"])
+            line_no, doc = valid[err["index"]]
+            msg = "form_no already exists" if err.get("code") == 11000 else err.get("errmsg", "insert failed")
+            report["errors"].append((line_no, doc["form_no"], msg))
+    inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+    if not inserted:
+        return
+
+    accounts_col.bulk_write([UpdateOne({"_id": d["_id"]}, account_update(d), upsert=True)
+                             for d in inserted], ordered=False)
+    bump_rollup(now, admissions=len(inserted))
+    for d in inserted:
+        student_index.upsert(d)
+    students_changed([d["_id"] for d in inserted])
+    report["inserted"] += len(inserted)
+
+
+@app.route('/students/import', methods=['GET', 'POST'])
+@login_required
+def import_students_page():
+    report = None
+    if request.method == 'POST':
+        f = request.files.get('file')
+        if not f or not f.filename:
+            flash("Choose a CSV or XLSX file to import.", "danger")
+            return redirect(url_for('import_students_page'))
+        dry_run = bool(request.form.get('dry_run'))
+        try:
+            report = import_students(read_rows(f.filename, f.stream), dry_run=dry_run)
+        except ValueError as e:
+            flash(str(e), "danger")
+            return redirect(url_for('import_students_page'))
+        if dry_run:
+            flash(f"Checked {report['rows']} rows: {report['valid']} ready to import, "
+                  f"{len(report['errors'])} with errors.", "info")
+        else:
+            flash(f"Imported {report['inserted']} of {report['rows']} students.",
+                  "success" if not report["errors"] else "warning")
+    return render_template('student_import.html', report=report)
+
+
+@app.cli.command("import-students")
+@click.argument("path")
+@click.option("--dry-run", is_flag=True, help="Validate only, write nothing.")
+def import_students_command(path, dry_run):
+    """Bulk-import students from a CSV or XLSX file, printing per-row errors."""
+    with open(path, "rb") as f:
+        report = import_students(read_rows(path, f), dry_run=dry_run)
+    for line_no, form_no, message in report["errors"]:
+        print(f"line {line_no} (form_no {form_no or '-'}): {message}")
+    print(f"rows={report['rows']} valid={report['valid']} inserted={report['inserted']} "
+          f"errors={len(report['errors'])}")
+
+
 
 @app.route('/student/delete/<sid>', methods=['POST'])
 def delete_student(sid):
-    db.students.delete_one({"_id": ObjectId(sid)})
+    removed = db.students.find_one_and_delete({"_id": ObjectId(sid)}, projection={"created_at": 1})
+    accounts_col.delete_one({"_id": ObjectId(sid)})
+    if removed:
+        bump_rollup(removed.get("created_at"), admissions=-1)
+    student_index.remove(ObjectId(sid))
+    students_changed([ObjectId(sid)])
     flash("Student removed.")
     return redirect(url_for('students_list'))
 
@@ -568,7 +1277,11 @@ def delete_student(sid):
 
 @app.route('/receipt/<receipt_no>')
 def print_receipt(receipt_no):
-    payment = db.payments.find_one({"receipt_no": receipt_no})
+    payment = None
+    if receipt_no.isdigit():
+        payment = db.payments.find_one({"receipt_seq": int(receipt_no)})
+    if not payment:
+        payment = db.payments.find_one({"receipt_no": receipt_no})
     if not payment:
         flash("Receipt not found.")
         return redirect(url_for('payments_list'))
@@ -599,6 +1312,57 @@ def print_receipt(receipt_no):
 
 
 
+REPORT_PAGE_SIZE = 100
+
+def payment_report_facet(match, after=None, before=None, per_page=REPORT_PAGE_SIZE, rows=True):
+    """
+    One aggregation over the matching payments returning:
+      totals     - grand total, GST total, count, first/last receipt
+      by_course / by_faculty / by_mode - {_id, total, gst, count} sorted by total
+      rows       - one keyset page (date desc) of payment documents (per_page + 1);
+                   left out (empty) with rows=False
+    """
+    amount = {"$ifNull": ["$total", "$amount"]}
+    receipt_num = {"$ifNull": ["$receipt_seq", {"$convert": {"input": "$receipt_no", "to": "long",
+                                                             "onError": None, "onNull": None}}]}
+
+    def breakdown(field):
+        return [
+            {"$group": {"_id": {"$ifNull": [field, ""]}, "total": {"$sum": amount},
+                        "gst": {"$sum": "$gst"}, "count": {"$sum": 1}}},
+            {"$sort": {"total": -1}}
+        ]
+
+    pipeline = [
+        {"$match": match},
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "total": {"$sum": amount},
+                "gst": {"$sum": "$gst"},
+                "count": {"$sum": 1},
+                "first_receipt_num": {"$min": receipt_num},
+                "last_receipt_num": {"$max": receipt_num},
+                "first_receipt": {"$min": "$receipt_no"},
+                "last_receipt": {"$max": "$receipt_no"}
+            }}],
+            "by_course": breakdown({"$ifNull": ["$course_name", "$course"]}),
+            "by_faculty": breakdown("$faculty"),
+            "by_mode": breakdown("$payment_mode"),
+        }}
+    ]
+    if rows:
+        pipeline[1]["$facet"]["rows"] = [
+            {"$match": keyset_query({}, "date", after, before)},
+            {"$sort": dict(keyset_sort("date", before))},
+            {"$limit": per_page + 1}
+        ]
+    res = list(payments.aggregate(pipeline, allowDiskUse=True))
+    out = res[0] if res else {"totals": [], "by_course": [], "by_faculty": [], "by_mode": []}
+    out.setdefault("rows", [])
+    return out
+
+
 @app.route('/reports/payment', methods=['GET', 'POST'])
 def payment_report():
     # request.values merges args (GET) and form (POST) — convenient for both methods
@@ -643,21 +1407,21 @@ def payment_report():
     if submit_date:
         q["created_at"] = {"$regex": submit_date}
 
-    # Receipt number range — parse safely
+    # Receipt number range — on the integer receipt_seq (receipt_no is a padded string)
     try:
         if from_receipt and to_receipt:
-            q["receipt_no"] = {"$gte": int(from_receipt), "$lte": int(to_receipt)}
+            q["receipt_seq"] = {"$gte": int(from_receipt), "$lte": int(to_receipt)}
         elif from_receipt:
-            q["receipt_no"] = {"$gte": int(from_receipt)}
+            q["receipt_seq"] = {"$gte": int(from_receipt)}
         elif to_receipt:
-            q["receipt_no"] = {"$lte": int(to_receipt)}
+            q["receipt_seq"] = {"$lte": int(to_receipt)}
     except ValueError:
         # ignore invalid ints (or add a flash message if you want)
         pass
 
-    # Course filter
+    # Course filter (payments store course_name; older rows may use course)
     if course and course != "All":
-        q["course"] = course
+        q["$or"] = [{"course_name": course}, {"course": course}]
 
     # NOTE: check your DB field name for new/old — below I put it into the same key name
     if old_new and old_new != "All":
@@ -670,74 +1434,53 @@ def payment_report():
     # Debug print — useful while developing
     print("Payment report query:", q, "method:", request.method)
 
-    payments_cursor = payments.find(q).sort("date", -1)
-    payment_list = list(payments_cursor)
-
-    # Build safe lists for the template (do not shadow collection names)
-    course_list = []
-    for c in courses.find():
-        # handle dict-like and attribute-like documents safely
-        name = c.get("name") if isinstance(c, dict) else getattr(c, "name", None)
-        if not name:
-            name = c.get("title") if isinstance(c, dict) else getattr(c, "title", None)
-        if name:
-            course_list.append(str(name).strip())
-
-    faculty_list = []
-    for f in faculties.find():
-        fname = f.get("name") if isinstance(f, dict) else getattr(f, "name", None)
-        if fname:
-            faculty_list.append(str(fname).strip())
-
     # -------------------------
-    # COMPUTE TOTAL AMOUNT
+    # TOTALS, BREAKDOWNS AND ONE PAGE OF ROWS IN A SINGLE $facet
     # -------------------------
-    total_amount = 0
-    for p in payment_list:
-        amt = p.get('total') or p.get('amount') or 0
-        try:
-            total_amount += float(amt)
-        except Exception:
-            # ignore bad values
-            pass
+    # ?print=1: every matching row under the totals (no paging), streamed as it renders
+    print_all = get("print") == "1"
+    after, before, per_page = keyset_args(REPORT_PAGE_SIZE)
+    facet = payment_report_facet(q, after, before, per_page, rows=not print_all)
+    totals = facet["totals"][0] if facet["totals"] else {}
+    if print_all:
+        payment_list = payments.find(q).sort(keyset_sort("date")) if totals.get("count") else []
+        next_token = prev_token = None
+    else:
+        payment_list, next_token, prev_token = keyset_page(facet["rows"], "date", per_page, after, before)
 
-    # -------------------------
-    # FIRST & LAST RECEIPT NO (prefer numeric min/max)
-    # -------------------------
-    if payment_list:
-        numeric_receipts = []
-        for p in payment_list:
-            r = p.get('receipt_no')
-            if r is None:
-                continue
-            try:
-                numeric_receipts.append(int(r))
-            except Exception:
-                # not numeric, skip here
-                pass
+    # Build safe lists for the template from the reference cache
+    course_list = [str(n).strip() for n in refdata.names("courses").values() if n]
+    faculty_list = [str(n).strip() for n in refdata.names("faculties").values() if n]
 
-        if numeric_receipts:
-            first_receipt_no = min(numeric_receipts)
-            last_receipt_no = max(numeric_receipts)
-        else:
-            # fallback to first/last in the returned list (string values or unsortable)
-            first_receipt_no = payment_list[0].get('receipt_no', '')
-            last_receipt_no = payment_list[-1].get('receipt_no', '')
-    else:
-        first_receipt_no = ''
-        last_receipt_no = ''
+    total_amount = totals.get("total", 0)
+    first_receipt_no = totals.get("first_receipt_num") or totals.get("first_receipt") or ''
+    last_receipt_no = totals.get("last_receipt_num") or totals.get("last_receipt") or ''
+
+    # filters echoed into the pager links (the form itself posts)
+    filters = {k: v for k, v in request.values.items()
+               if v and k not in ("after", "before", "per_page", "print")}
 
     # -------------------------
     # RENDER TEMPLATE
     # -------------------------
-    return render_template(
+    return (stream_template if print_all else render_template)(
         "reports_payment.html",
+        print_all=print_all,
         payments=payment_list,
         course_list=course_list,
         faculty_list=faculty_list,
         total_amount=total_amount,
+        gst_total=totals.get("gst", 0),
+        payment_count=totals.get("count", 0),
         first_receipt_no=first_receipt_no,
-        last_receipt_no=last_receipt_no
+        last_receipt_no=last_receipt_no,
+        by_course=facet["by_course"],
+        by_faculty=facet["by_faculty"],
+        by_mode=facet["by_mode"],
+        filters=filters,
+        per_page=per_page,
+        next_token=next_token,
+        prev_token=prev_token
     )
 
 
@@ -753,68 +1496,39 @@ def payment_report():
 
 @app.route('/reports/students')
 def student_report():
-    students = list(db.students.find().sort("created_at", -1))
-
-    # Collect unique batch_ids & course_ids
-    batch_ids = {s.get('batch_id') for s in students if s.get('batch_id')}
-    course_ids = {s.get('course_id') for s in students if s.get('course_id')}
-
-    # Fetch batch docs in one query
-    batches = {str(b['_id']): b for b in db.batches.find({
-        "_id": {"$in": list(batch_ids)}
-    })}
-
-    # Fetch course docs in one query
-    courses = {str(c['_id']): c for c in db.courses.find({
-        "_id": {"$in": list(course_ids)}
-    })}
-
-    # Process each student
+    # balance, paid and course fee come from the shared balance engine (one aggregation),
+    # one keyset page at a time
+    after, before, per_page = keyset_args()
+    rows = student_balances(keyset_query({}, "created_at", after, before),
+                            sort=dict(keyset_sort("created_at", before)),
+                            limit=per_page + 1)
+    students, next_token, prev_token = keyset_page(rows, "created_at", per_page, after, before)
+
+    # Process each student (batch / course docs come from the reference cache)
     for s in students:
 
         # ------------------------------
         # 1️⃣ Attach batch details
         # ------------------------------
         if s.get("batch_id"):
-            s["batch"] = batches.get(str(s["batch_id"]))
+            s["batch"] = refdata.get("batches", s["batch_id"])
 
         # ------------------------------
         # 2️⃣ Attach course details
         # ------------------------------
         if s.get("course_id"):
-            s["course"] = courses.get(str(s["course_id"]))
-
-        # ------------------------------
-        # 3️⃣ Compute Expiry Date
-        # ------------------------------
-        if not s.get("expiry_date") and s.get("admission_date"):
-            try:
-                ad = datetime.strptime(s["admission_date"], "%Y-%m-%d")
-                # Example: course contains duration_months
-                months = int(s["course"].get("duration_months", 0)) if s.get("course") else 0
-                expiry = ad + timedelta(days=months * 30)
-                s["expiry_date"] = expiry.strftime("%Y-%m-%d")
-            except:
-                s["expiry_date"] = ""
+            s["course"] = refdata.get("courses", s["course_id"])
 
         # ------------------------------
-        # 4️⃣ Compute Balance
+        # 3️⃣ Expiry Date (stored typed; computed only for rows not yet backfilled)
         # ------------------------------
-        total_paid = 0
-        for p in db.payments.find({"student_id": s["_id"]}):
-            total_paid += float(p.get("amount", 0))
-
-        course_fee = 0
+        expiry = s.get("expiry_date")
+        if not isinstance(expiry, datetime):
+            expiry = compute_expiry_date(s, s.get("batch"), s.get("course"))
+        s["expiry_date"] = expiry.strftime("%Y-%m-%d") if expiry else ""
 
-        # Prefer student fee field, else course fee
-        if "fee" in s:
-            course_fee = float(s.get("fee", 0))
-        elif s.get("course"):
-            course_fee = float(s["course"].get("fee", 0))
-
-        s["balance"] = course_fee - total_paid
-
-    return render_template("student_report.html", students=students)
+    return render_template("student_report.html", students=students, per_page=per_page,
+                           next_token=next_token, prev_token=prev_token)
 
 
 
@@ -855,68 +1569,273 @@ def summary_today():
 
 # /receipt/<receipt_no> — print receipt (if you already have this, keep it).
 
+# --- Balance engine: shared by /payments, /reports/students and /notifications ---
+LEDGER_PAGE_SIZE = 50
+
+# students.course_id may be an ObjectId or its string form
+COURSE_OID_EXPR = {"$convert": {"input": "$course_id", "to": "objectId",
+                                "onError": "$course_id", "onNull": None}}
+
+def fee_ledger_stages():
+    """
+    Pipeline stages (run on students) that attach course_name, course_fee, paid,
+    gst_paid, balance, last_payment and installments to every student document.
+    payments.student_id holds the student's ObjectId; course_id may be ObjectId or string.
+    A 'fee' stored on the student overrides the course fee.
+    """
+    return [
+        {"$addFields": {"_cid": COURSE_OID_EXPR}},
+        {"$lookup": {"from": "courses", "localField": "_cid", "foreignField": "_id", "as": "_course"}},
+        {"$lookup": {"from": "payments", "localField": "_id", "foreignField": "student_id", "as": "_pay"}},
+        {"$addFields": {
+            "course_name": {"$ifNull": [{"$arrayElemAt": ["$_course.name", 0]}, ""]},
+            "course_fee": {"$ifNull": ["$fee", {"$ifNull": [{"$arrayElemAt": ["$_course.fee", 0]}, 0]}]},
+            "paid": {"$sum": "$_pay.amount"},
+            "gst_paid": {"$sum": "$_pay.gst"},
+            "last_payment": {"$max": "$_pay.date"},
+            "installments": {"$size": "$_pay"}
+        }},
+        {"$addFields": {"balance": {"$subtract": ["$course_fee", "$paid"]}}},
+        {"$project": {"_cid": 0, "_course": 0, "_pay": 0}}
+    ]
+
+
+def student_balances(query=None, sort=None, min_balance=None, limit=None):
+    """
+    Cursor over students (matching query) enriched with the fee_ledger_stages fields.
+    Payments for every student are summed server-side in the same aggregation.
+    min_balance keeps only students whose balance is greater than that value;
+    limit cuts the (sorted) students before payments are joined.
+    """
+    pipeline = [{"$match": query or {}}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline += fee_ledger_stages()
+    if min_balance is not None:
+        pipeline.append({"$match": {"balance": {"$gt": min_balance}}})
+    return db.students.aggregate(pipeline, allowDiskUse=True)
+
+
+def fee_ledger(query=None, sort="recent", after=None, before=None, per_page=LEDGER_PAGE_SIZE):
+    """
+    Return (rows, next_token, prev_token) for one keyset page of the fee ledger
+    in a single round trip.
+    sort: 'recent' (created_at desc) or 'balance' (highest balance first).
+    When sorting by recency the page is cut before the payment lookups, so only
+    per_page students are joined against payments. By balance the page is read
+    from student_accounts on its balance index and only those students are loaded.
+    """
+    if sort == "balance":
+        return balance_ledger(query, after, before, per_page)
+
+    field = "created_at"
+    pipeline = [
+        {"$match": keyset_query(query or {}, field, after, before)},
+        {"$sort": dict(keyset_sort(field, before))},
+        {"$limit": per_page + 1}
+    ] + fee_ledger_stages()
+
+    rows = db.students.aggregate(pipeline, allowDiskUse=True)
+    return keyset_page(rows, field, per_page, after, before)
+
+
+def balance_ledger(query=None, after=None, before=None, per_page=LEDGER_PAGE_SIZE):
+    """fee_ledger(sort="balance"): one keyset page of student_accounts, joined to its students."""
+    account_query = {}
+    if query:
+        account_query = {"_id": {"$in": db.students.distinct("_id", query)}}
+    accounts = list(accounts_col.find(keyset_query(account_query, "balance", after, before))
+                    .sort(keyset_sort("balance", before)).limit(per_page + 1))
+    students = {s["_id"]: s for s in db.students.find({"_id": {"$in": [a["_id"] for a in accounts]}})}
+
+    rows = []
+    for a in accounts:
+        # same fields as fee_ledger_stages(), taken from the account
+        course = refdata.get("courses", a.get("course_id")) or {}
+        row = dict(students.get(a["_id"]) or {"first_name": a.get("student_name", "")})
+        row.update({
+            "_id": a["_id"],
+            "course_name": course.get("name") or "",
+            "course_fee": a.get("fee", 0),
+            "paid": a.get("paid", 0),
+            "gst_paid": a.get("gst", 0),
+            "balance": a.get("balance"),
+            "last_payment": a.get("last_payment"),
+            "installments": a.get("installments", 0),
+        })
+        rows.append(row)
+    return keyset_page(rows, "balance", per_page, after, before)
+
+
+# --- student_accounts: materialized fee/balance read model ---
+# One document per student (_id = student _id) holding fee, paid, gst, balance,
+# last_payment and installments. Payment writes update it with $inc; student and
+# course edits re-price it; rebuild_student_accounts() regenerates it from payments.
+
+def rebuild_student_accounts(query=None):
+    """Regenerate student_accounts for students matching query (all when None)."""
+    pipeline = [{"$match": query or {}}] + fee_ledger_stages() + [
+        {"$project": {
+            "_id": 1,
+            "student_name": {"$trim": {"input": {"$concat": [
+                {"$ifNull": ["$first_name", ""]}, " ", {"$ifNull": ["$last_name", ""]}]}}},
+            "course_id": COURSE_OID_EXPR,
+            "batch_id": 1,
+            "fee_override": {"$ne": [{"$ifNull": ["$fee", None]}, None]},
+            "fee": "$course_fee",
+            "paid": 1,
+            "gst": "$gst_paid",
+            "balance": 1,
+            "last_payment": 1,
+            "installments": 1,
+            "updated_at": "$$NOW"
+        }},
+        {"$merge": {"into": "student_accounts", "on": "_id",
+                    "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    db.students.aggregate(pipeline, allowDiskUse=True)
+    if query is None:
+        # drop accounts whose student no longer exists
+        live = set(db.students.distinct("_id"))
+        stale = [a["_id"] for a in accounts_col.find({}, {"_id": 1}) if a["_id"] not in live]
+        if stale:
+            accounts_col.delete_many({"_id": {"$in": stale}})
+
+
+def account_update(student):
+    """
+    Update pipeline re-pricing a student's account from the student document.
+    Paid, gst, installments and last_payment are kept; balance follows the new fee.
+    """
+    fee_override = student.get("fee") is not None
+    course_oid = student.get("course_id")
+    if course_oid and not isinstance(course_oid, ObjectId):
+        try:
+            course_oid = ObjectId(course_oid)
+        except Exception:
+            pass
+    if fee_override:
+        fee = float(student.get("fee") or 0)
+    else:
+        course = refdata.get("courses", course_oid)
+        fee = float((course or {}).get("fee") or 0)
+
+    paid = {"$ifNull": ["$paid", 0]}
+    return [{"$set": {
+        "student_name": f"{student.get('first_name','')} {student.get('last_name') or ''}".strip(),
+        "course_id": course_oid,
+        "batch_id": student.get("batch_id"),
+        "fee_override": fee_override,
+        "fee": fee,
+        "paid": paid,
+        "gst": {"$ifNull": ["$gst", 0]},
+        "installments": {"$ifNull": ["$installments", 0]},
+        "balance": {"$subtract": [fee, paid]},
+        "updated_at": datetime.utcnow()
+    }}]
+
+
+def refresh_student_account(student):
+    """Re-price one student's account after the student (course / fee / name) changed."""
+    res = accounts_col.update_one({"_id": student["_id"]}, account_update(student))
+    if res.matched_count == 0:
+        # no account yet (new or legacy student): build it from payments, never from zeros
+        rebuild_student_accounts({"_id": student["_id"]})
+
+
+def record_account_payment(pay_doc):
+    """Apply one inserted payment to the payer's account incrementally."""
+    res = accounts_col.update_one({"_id": pay_doc["student_id"]}, {
+        "$inc": {
+            "paid": pay_doc.get("amount", 0),
+            "gst": pay_doc.get("gst", 0),
+            "installments": 1,
+            "balance": -pay_doc.get("amount", 0)
+        },
+        "$max": {"last_payment": pay_doc["date"]},
+        "$set": {"updated_at": datetime.utcnow()}
+    })
+    if res.matched_count == 0:
+        # student predates the read model: build the account from payments (includes this one)
+        rebuild_student_accounts({"_id": pay_doc["student_id"]})
+
+
+def reprice_course_accounts(course_id, fee):
+    """Course fee changed: update every account that takes its fee from this course."""
+    fee = float(fee or 0)
+    accounts_col.update_many(
+        {"course_id": course_id, "fee_override": {"$ne": True}},
+        [{"$set": {
+            "fee": fee,
+            "balance": {"$subtract": [fee, {"$ifNull": ["$paid", 0]}]},
+            "updated_at": datetime.utcnow()
+        }}]
+    )
+
+
+def count_fees_due():
+    """Number of students with a positive balance (navbar badge)."""
+    return accounts_col.count_documents({"balance": {"$gt": 0}})
+
+
+@app.cli.command("rebuild-accounts")
+def rebuild_accounts_command():
+    """Regenerate the student_accounts read model from students and payments."""
+    rebuild_student_accounts()
+    db.migrations.update_one({"_id": "student_accounts"},
+                             {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+    print("student_accounts rebuilt:", accounts_col.count_documents({}), "accounts")
+
+
+def bootstrap_student_accounts():
+    """
+    Fill student_accounts once per database before anything reads it (fees due,
+    navbar badge, payments list). Marked done in db.migrations; workers starting
+    together may both rebuild, which is harmless ($merge replaces by _id).
+    """
+    try:
+        if db.migrations.find_one({"_id": "student_accounts", "state": "done"}):
+            return
+        rebuild_student_accounts()
+        db.migrations.update_one({"_id": "student_accounts"},
+                                 {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+        print("✅ student_accounts built:", accounts_col.count_documents({}), "accounts")
+    except Exception as e:
+        print("❌ student_accounts bootstrap failed:", e)
+
+bootstrap_student_accounts()
+
+
 # --- Payments list: show all students with balances & actions ---
 @app.route('/payments')
 def payments_list():
     q = request.args.get('q','').strip()
+    sort = request.args.get('sort', 'recent')
+    if sort not in ("recent", "balance"):
+        sort = "recent"
+    after, before, per_page = keyset_args(LEDGER_PAGE_SIZE)
+
     # fetch students (optionally filter by q)
     query = {}
     if q:
-        query = {"$or":[
-            {"first_name":{"$regex":q,"$options":"i"}},
-            {"last_name":{"$regex":q,"$options":"i"}},
-            {"phone":{"$regex":q}},
-            {"form_no":{"$regex":q}},
-            {"aadhar":{"$regex":q}}
-        ]}
-    students = list(db.students.find(query).sort("created_at",-1))
-
-    # enrich students with course info and balance & last payment date
-    enriched = []
-    for s in students:
-        student = s.copy()
-        # get course
-        course = None
-        if student.get("course_id"):
-            try:
-                course = db.courses.find_one({"_id": ObjectId(student["course_id"])})
-            except:
-                course = db.courses.find_one({"_id": student["course_id"]})
-        # course fee
-        fee = course.get("fee",0) if course else 0
-
-        # sum of payments made (total field in payments)
-        paid_agg = db.payments.aggregate([
-            {"$match": {"student_id": student.get("_id")}},
-            {"$group": {"_id": None, "sumPaid": {"$sum": "$amount"}}}
-        ])
-        paid_list = list(paid_agg)
-        paid = paid_list[0]['sumPaid'] if paid_list else 0.0
-
-        # compute balance = fee - paid (if you store balance separately you can use it instead)
-        balance = fee - paid
-
-        # get last payment and number of installments
-        last_pay = db.payments.find_one({"student_id": student.get("_id")}, sort=[("date",-1)])
-        installments_count = db.payments.count_documents({"student_id": student.get("_id")})
+        # indexed name-prefix / number-suffix match on the search keys
+        query = search_filter(q)
 
-        student['course_name'] = course.get("name") if course else ""
-        student['course_fee'] = fee
-        student['paid'] = paid
-        student['balance'] = balance
-        student['last_payment'] = last_pay['date'] if last_pay else None
-        student['installments'] = installments_count
+    # course, fee, paid, balance, last payment and installments in one aggregation
+    students, next_token, prev_token = fee_ledger(query, sort=sort, after=after, before=before,
+                                                  per_page=per_page)
 
-        enriched.append(student)
-
-    return render_template('payments_list.html', payments=[], students=enriched, q=q)
+    return render_template('payments_list.html', payments=[], students=students, q=q,
+                           sort=sort, per_page=per_page,
+                           next_token=next_token, prev_token=prev_token)
 
 
 #  _______faculty_routes____
 @app.route('/faculty')
 def faculty_list():
-    data = list(faculties.find())
-    return render_template('faculty_list.html', faculties=data)
+    return render_template('faculty_list.html', faculties=refdata.all("faculties"))
 
 @app.route('/faculty/add', methods=['GET', 'POST'])
 def faculty_form():
@@ -929,6 +1848,7 @@ def faculty_form():
             "address": request.form.get("address")
         }
         faculties.insert_one(doc)
+        refdata.bump("faculties")
         flash("Faculty added successfully!")
         return redirect(url_for('faculty_list'))
     return render_template('faculty_form.html', faculty=None)
@@ -947,6 +1867,7 @@ def edit_faculty(id):
             "subject": request.form.get("subject"),
             "address": request.form.get("address")
         }})
+        refdata.bump("faculties")
         flash("Faculty updated successfully!")
         return redirect(url_for('faculty_list'))
     return render_template('faculty_form.html', faculty=faculty)
@@ -954,10 +1875,31 @@ def edit_faculty(id):
 @app.route('/faculty/delete/<id>')
 def delete_faculty(id):
     faculties.delete_one({"_id": ObjectId(id)})
+    refdata.bump("faculties")
     flash("Faculty deleted successfully.")
     return redirect(url_for('faculty_list'))
 
 
+def insert_payment(pay_doc):
+    """
+    Number a payment from the receipt_no counter and insert it; returns the receipt
+    number. In gap-free mode on a server with transactions the counter step and
+    the insert commit together, so a failed insert never burns a receipt number.
+    """
+    def number_and_insert(session=None):
+        receipt_seq = sequences.next("receipt_no", session=session)
+        pay_doc["receipt_no"] = str(receipt_seq).zfill(6)
+        pay_doc["receipt_seq"] = int(receipt_seq)   # typed copy for range queries / seeks
+        db.payments.insert_one(pay_doc, session=session)
+
+    if RECEIPT_GAPFREE and schema.supports("transactions"):
+        with client.start_session() as s:
+            s.with_transaction(number_and_insert)
+    else:
+        number_and_insert()
+    return pay_doc["receipt_no"]
+
+
 @app.route('/payment/add/<student_id>', methods=['GET','POST'])
 def add_payment(student_id):
     # fetch student
@@ -983,10 +1925,8 @@ def add_payment(student_id):
             if isinstance(cid, ObjectId):
                 course_obj_ids.append(cid)
 
-    # Fetch course documents (projection - only what you need)
-    courses = []
-    if course_obj_ids:
-        courses = list(db.courses.find({"_id": {"$in": course_obj_ids}}, {"name": 1, "duration": 1}).sort("name", 1))
+    # Course documents from the reference cache (already sorted by name)
+    courses = [c for c in refdata.all("courses") if c["_id"] in course_obj_ids]
 
     # If a student had only one course, set default selected course (None otherwise)
     default_course = None
@@ -1017,21 +1957,14 @@ def add_payment(student_id):
             if found:
                 course_name = found.get("name", "")
             else:
-                # fallback: fetch single course doc (handles case when course wasn't in course_obj_ids)
-                try:
-                    cdoc = db.courses.find_one({"_id": ObjectId(selected_course_id)}, {"name":1})
-                except Exception:
-                    cdoc = db.courses.find_one({"_id": selected_course_id}, {"name":1})
+                # fallback: any course (handles case when course wasn't in course_obj_ids)
+                cdoc = refdata.get("courses", selected_course_id)
                 if cdoc:
                     course_name = cdoc.get("name", "")
 
         # calculate gst & total (use your existing calc_gst function)
         gst, total = calc_gst(amount, GST_PERCENT)
 
-        # receipt number from counters
-        receipt_seq = get_next_sequence(db, "receipt_no")
-        receipt_no = str(receipt_seq).zfill(6)
-
         pay_doc = {
             "student_id": student["_id"],
             "student_name": f"{student.get('first_name','')} {student.get('last_name','')}".strip(),
@@ -1044,13 +1977,14 @@ def add_payment(student_id):
             "faculty": faculty,
             "payment_mode": payment_mode,
             "installment": installment_label,
-            "receipt_no": receipt_no,
             "remarks": remarks,
             "phone": student.get("phone"),
             "gender": student.get("gender"),
         }
 
-        db.payments.insert_one(pay_doc)
+        receipt_no = insert_payment(pay_doc)
+        record_account_payment(pay_doc)
+        bump_rollup(pay_doc["date"], collections=amount, gst=gst)
 
         flash(f"Payment recorded. Receipt No: {receipt_no}")
         return redirect(url_for('print_receipt', receipt_no=receipt_no))
@@ -1108,9 +2042,9 @@ def edit_student(sid):
             student['faculty_id'] = student.get('faculty_id')
 
     # load lists and convert their ids to strings for template
-    batches = list(db.batches.find())
-    courses = list(db.courses.find())
-    faculties = list(db.faculties.find())
+    batches = refdata.all("batches")
+    courses = refdata.all("courses")
+    faculties = refdata.all("faculties")
 
     for b in batches:
         b['_id'] = str(b['_id'])
@@ -1127,6 +2061,7 @@ def edit_student(sid):
             'admission_date','payment_status','reference','form_no',
             'blood_group'
         ]}
+        update['search'] = search_keys(update)
 
         # handle batch/course (store as ObjectId if provided, else unset)
         if request.form.get('batch_id'):
@@ -1153,7 +2088,7 @@ def edit_student(sid):
                 oid = ObjectId(faculty_id)
                 update['faculty_id'] = oid
                 # look up faculty name and store it too for easy display
-                fac = db.faculties.find_one({'_id': oid})
+                fac = refdata.get("faculties", oid)
                 update['faculty'] = fac.get('name') if fac else faculty_text or None
             except (InvalidId, TypeError):
                 # invalid id -> fallback to text
@@ -1173,6 +2108,7 @@ def edit_student(sid):
             path = os.path.join(upload_folder, fname)
             photo.save(path)
             update['photo'] = fname
+            photos.submit(fname)
 
         # update DB (use ObjectId for the selector if possible)
         try:
@@ -1183,6 +2119,12 @@ def edit_student(sid):
             selector = {"_id": doc["_id"]} if doc else {"form_no": sid}
 
         db.students.update_one(selector, {"$set": update})
+        updated = db.students.find_one(selector)
+        if updated:
+            refresh_student_account(updated)
+            refresh_expiry_dates({"_id": updated["_id"]})
+            student_index.upsert(updated)
+        students_changed([updated["_id"]] if updated else None)
         flash("Student updated.")
         return redirect(url_for('students_list'))
 
@@ -1196,6 +2138,17 @@ def edit_student(sid):
 
 
 
+@app.cli.command("backfill-receipt-seq")
+def backfill_receipt_seq_command():
+    """Store the integer receipt_seq on payments that only have the padded receipt_no."""
+    res = db.payments.update_many(
+        {"receipt_seq": {"$exists": False}, "receipt_no": {"$regex": "^[0-9]+$"}},
+        [{"$set": {"receipt_seq": {"$toLong": "$receipt_no"}}}]
+    )
+    left = db.payments.count_documents({"receipt_seq": {"$exists": False}})
+    print("receipt_seq set on", res.modified_count, "payments;", left, "without a numeric receipt_no")
+
+
 # ---------- Helper utilities ----------
 def iso_today():
     return date.today().isoformat()
@@ -1214,12 +2167,19 @@ def seed():
     if batches_col.count_documents({}) == 0:
         b1 = batches_col.insert_one({"name": "Batch A"}).inserted_id
         b2 = batches_col.insert_one({"name": "Batch B"}).inserted_id
+        refdata.bump("batches")
 
-        students_col.insert_many([
+        sample = [
             {"first_name": "Amit", "last_name": "Sharma", "phone": "9876500001", "form_no": "A001", "photo": None, "batch_id": b1},
             {"first_name": "Rina", "last_name": "Kumar", "phone": "9876500002", "form_no": "A002", "photo": None, "batch_id": b1},
             {"first_name": "Sandeep", "last_name": "Das", "phone": "9876500003", "form_no": "B001", "photo": None, "batch_id": b2},
-        ])
+        ]
+        for doc in sample:
+            doc["search"] = search_keys(doc)
+        students_col.insert_many(sample)
+        for doc in sample:
+            student_index.upsert(doc)
+        students_changed([doc["_id"] for doc in sample])
         return "Seeded sample data"
     return "Already seeded"
 
@@ -1227,6 +2187,82 @@ def seed():
 # ---------- Attendance routes (replace the old block with this) ----------
 
 
+# ---------- Attendance sessions ----------
+# Student attendance is stored as one attendance_sessions document per (batch_id, date):
+#   {"batch_id": "<batch id str>", "date": "YYYY-MM-DD", "statuses": {"<student id str>": "present"}}
+# The legacy per-student attendance documents are folded in by 'flask --app app
+# migrate-attendance'; the attendance collection itself is still used for teacher hours.
+
+def load_session_statuses(att_date, batch_id):
+    """{student_id: status} for one batch on one date (empty if not taken yet)."""
+    doc = sessions_col.find_one({"batch_id": batch_id, "date": att_date}, {"statuses": 1})
+    return (doc or {}).get("statuses") or {}
+
+
+def migrate_attendance_sessions():
+    """
+    Group per-student attendance documents into attendance_sessions. Idempotent:
+    statuses already present on a session win over the legacy rows.
+    """
+    # $merge on (batch_id, date) needs the unique index, which startup skips
+    # under SKIP_INDEX_BOOTSTRAP=1
+    errors = ensure_indexes(db, ["attendance_sessions"])
+    if errors:
+        raise RuntimeError("; ".join(errors["attendance_sessions"]))
+    attendance_col.aggregate([
+        {"$match": {"student_id": {"$exists": True}, "batch_id": {"$exists": True}}},
+        {"$group": {
+            "_id": {"date": "$date", "batch_id": "$batch_id"},
+            "pairs": {"$push": {"k": {"$toString": "$student_id"}, "v": "$status"}},
+            "updated_at": {"$max": "$updated_at"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "date": "$_id.date",
+            "batch_id": "$_id.batch_id",
+            "statuses": {"$arrayToObject": "$pairs"},
+            "updated_at": 1
+        }},
+        {"$merge": {
+            "into": "attendance_sessions",
+            "on": ["batch_id", "date"],
+            "whenMatched": [{"$set": {"statuses": {"$mergeObjects": ["$$new.statuses", "$statuses"]}}}],
+            "whenNotMatched": "insert"
+        }}
+    ], allowDiskUse=True)
+
+
+@app.cli.command("migrate-attendance")
+def migrate_attendance_command():
+    """Fold per-student attendance documents into per-session documents."""
+    legacy = attendance_col.count_documents({"student_id": {"$exists": True}})
+    migrate_attendance_sessions()
+    db.migrations.update_one({"_id": "attendance_sessions"},
+                             {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+    rebuild_rollups()
+    print(f"Migrated {legacy} attendance rows into", sessions_col.count_documents({}), "sessions")
+
+
+def bootstrap_attendance_sessions():
+    """
+    The attendance pages only read attendance_sessions, so fold the legacy
+    per-student rows in once per database (marked in db.migrations) and rebuild
+    the rollups from the result.
+    """
+    try:
+        if db.migrations.find_one({"_id": "attendance_sessions", "state": "done"}):
+            return
+        migrate_attendance_sessions()
+        db.migrations.update_one({"_id": "attendance_sessions"},
+                                 {"$set": {"state": "done", "updated_at": datetime.utcnow()}}, upsert=True)
+        rebuild_rollups()
+        print("✅ attendance_sessions migrated:", sessions_col.count_documents({}), "sessions")
+    except Exception as e:
+        print("❌ attendance_sessions migration failed:", e)
+
+bootstrap_attendance_sessions()
+
+
 @app.route('/attendance')
 def attendance():
     """
@@ -1239,10 +2275,9 @@ def attendance():
     selected_batch = request.args.get('batch')  # string or None
 
     # Load batches and convert _id to string for template comparison
-    raw_batches = list(batches_col.find({}).sort("start_date", -1))
     batches = []
-    for b in raw_batches:
-        doc = dict(b)  # copy so we don't mutate DB doc directly
+    for b in refdata.all("batches"):
+        doc = dict(b)
         doc['_id'] = str(b.get('_id'))
         doc['display_name'] = b.get('title') or b.get('name') or doc['_id']
         batches.append(doc)
@@ -1262,12 +2297,10 @@ def attendance():
                 students.append(s)
 
     # Preload existing attendance for the date+batch to pre-select buttons
-    # NOTE: we store attendance.batch_id as string in save_attendance, so query with the string
+    # NOTE: sessions keep batch_id as the string form, so query with the string
     attendance_map = {}
     if selected_batch:
-        docs = attendance_col.find({"date": q_date, "batch_id": selected_batch})
-        for d in docs:
-            attendance_map[d["student_id"]] = d.get("status", "absent")
+        attendance_map = load_session_statuses(q_date, selected_batch)
 
     # Attach status to students
     for s in students:
@@ -1301,84 +2334,109 @@ def save_attendance():
     except Exception:
         return "Invalid batch id", 400
 
-    students = list(students_col.find({"batch_id": bid_obj}))
+    students = list(students_col.find({"batch_id": bid_obj}, {"_id": 1}))
     now = datetime.utcnow()
 
-    # Save or update each student's attendance record for that date+batch
-    # note: attendance documents keep batch_id as the string form for easy URL queries
+    # existing statuses for this session, so only changed entries are written
+    existing = load_session_statuses(attend_date, batch_id)
+
+    changes = {}
+    inserted = modified = unchanged = present_delta = 0
     for s in students:
         sid = str(s["_id"])
-        key = f"status_{sid}"
-        status = form.get(key, "absent")
-        attendance_col.update_one(
-            {"date": attend_date, "batch_id": batch_id, "student_id": sid},
-            {"$set": {
-                "status": status,
-                "updated_at": now,
-                "batch_id": batch_id,
-                "student_id": sid,
-                "date": attend_date
-            }},
-            upsert=True
-        )
-
+        status = form.get(f"status_{sid}", "absent")
+        if existing.get(sid) == status:
+            unchanged += 1
+            continue
+        if sid in existing:
+            modified += 1
+        else:
+            inserted += 1
+        present_delta += (status == "present") - (existing.get(sid) == "present")
+        changes[f"statuses.{sid}"] = status
+
+    if changes:
+        # one round trip: $set only the changed student entries of the session document
+        changes["updated_at"] = now
+        sessions_col.update_one({"batch_id": batch_id, "date": attend_date}, {"$set": changes}, upsert=True)
+        bump_rollup(attend_date, attendance_marked=inserted, attendance_present=present_delta)
+
+    summary = {"inserted": inserted, "modified": modified, "unchanged": unchanged}
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(summary)
+    flash(f"Attendance saved: {inserted} new, {modified} updated, {unchanged} unchanged.")
     return redirect(url_for('attendance', date=attend_date, batch=batch_id))
 
 
+MAX_EXPORT_DAYS = 366
+
+def csv_line(row):
+    """One properly quoted CSV line (used by the streaming exporters)."""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+
 @app.route('/attendance/export_csv')
 def attendance_export_csv():
     """
-    Returns a CSV for given date and optional batch query params:
-      - date=yyyy-mm-dd
-      - batch=<batch id>
+    Streams a students x dates attendance matrix as CSV. Query params:
+      - date=yyyy-mm-dd                  single day (default today), or
+      - from=yyyy-mm-dd&to=yyyy-mm-dd    a date range (max MAX_EXPORT_DAYS days)
+      - batch=<batch id>                 optional; repeat or comma-separate for several
+                                         batches (default: every batch with attendance)
+    Rows are written while the students cursor is read, so memory stays flat.
     """
-    q_date = parse_date(request.args.get('date'))
-    batch_id = request.args.get('batch')
-
-    query = {"date": q_date}
-    if batch_id:
-        query["batch_id"] = batch_id
-
-    docs = list(attendance_col.find(query))
-    status_map = {d["student_id"]: d["status"] for d in docs}
+    from_s = request.args.get('from') or request.args.get('date') or iso_today()
+    to_s = request.args.get('to') or from_s
+    try:
+        start = datetime.strptime(from_s, "%Y-%m-%d").date()
+        end = datetime.strptime(to_s, "%Y-%m-%d").date()
+    except ValueError:
+        return abort(400, "Invalid date")
+    if end < start or (end - start).days >= MAX_EXPORT_DAYS:
+        return abort(400, "Invalid date range")
+    days = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    date_q = {"$gte": days[0], "$lte": days[-1]}
 
-    # If batch specified, fetch students for that batch (students use ObjectId)
-    students = []
-    if batch_id:
-        try:
-            students = list(students_col.find({"batch_id": ObjectId(batch_id)}).sort([("first_name", 1)]))
-        except Exception:
+    batch_ids = [b for raw in request.args.getlist('batch') for b in raw.split(',') if b]
+    if batch_ids:
+        if not all(ObjectId.is_valid(b) for b in batch_ids):
             return abort(400, "Invalid batch id")
+        batch_oids = [ObjectId(b) for b in batch_ids]
     else:
-        # all students referenced in attendance
-        student_ids = list(status_map.keys())
-        oid_list = []
-        for sid in student_ids:
-            try:
-                oid_list.append(ObjectId(sid))
-            except Exception:
-                pass
-        students = list(students_col.find({"_id": {"$in": oid_list}}))
-
-    # Build CSV
-    si = io.StringIO()
-    writer = csv.writer(si)
-    writer.writerow(["Sr", "Student Name", "Phone", "Admission No", "Status"])
-
-    for i, s in enumerate(students, start=1):
-        sid = str(s["_id"])
-        name = f"{s.get('first_name','')} {s.get('last_name','')}".strip()
-        phone = s.get('phone', '')
-        form_no = s.get('form_no', '')
-        status = status_map.get(sid, "absent")
-        writer.writerow([i, name, phone, form_no, status])
+        # every batch with sessions in range; legacy ids that aren't ObjectIds are
+        # kept as they are and matched against students.batch_id as stored
+        batch_ids = sorted(sessions_col.distinct("batch_id", {"date": date_q}), key=str)
+        batch_oids = [ObjectId(str(b)) if ObjectId.is_valid(str(b)) else b for b in batch_ids]
+    batch_titles = refdata.names("batches")
 
-    si.seek(0)
-    mem = io.BytesIO()
-    mem.write(si.getvalue().encode('utf-8'))
-    mem.seek(0)
-    filename = f"attendance_{q_date}.csv"
-    return send_file(mem, as_attachment=True, download_name=filename, mimetype='text/csv')
+    def generate():
+        yield csv_line(["Sr", "Batch", "Student Name", "Phone", "Admission No"] + days + ["Present"])
+        sr = 0
+        for batch_id, bid in zip(batch_ids, batch_oids):
+            # statuses for this batch over the range: one small doc per session day
+            by_day = {d["date"]: d.get("statuses") or {} for d in
+                      sessions_col.find({"batch_id": batch_id, "date": date_q}, {"date": 1, "statuses": 1})}
+            cursor = (students_col.find({"batch_id": bid},
+                                        {"first_name": 1, "last_name": 1, "phone": 1, "form_no": 1})
+                      .sort([("first_name", 1), ("last_name", 1)])
+                      .batch_size(500))
+            for s in cursor:
+                sr += 1
+                sid = str(s["_id"])
+                marks = [by_day[d].get(sid, "absent") if d in by_day else "" for d in days]
+                yield csv_line([
+                    sr,
+                    batch_titles.get(str(batch_id)) or batch_id,
+                    f"{s.get('first_name','')} {s.get('last_name','')}".strip(),
+                    s.get('phone', ''),
+                    s.get('form_no', ''),
+                ] + marks + [marks.count("present")])
+
+    filename = f"attendance_{days[0]}.csv" if len(days) == 1 else f"attendance_{days[0]}_{days[-1]}.csv"
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 
 @app.route('/api/batch/<batch_id>/students')
@@ -1417,17 +2475,19 @@ def attendance_history():
     if q_batch:
         q['batch_id'] = q_batch
 
+    # one session document per (date, batch); count = students marked in it
     pipeline = [
         {"$match": q},
-        {"$group": {"_id": {"date": "$date", "batch_id": "$batch_id"}, "count": {"$sum": 1}}},
-        {"$sort": {"_id.date": -1}}
+        {"$sort": {"date": -1}},
+        {"$project": {
+            "_id": {"date": "$date", "batch_id": "$batch_id"},
+            "count": {"$size": {"$objectToArray": {"$ifNull": ["$statuses", {}]}}}
+        }}
     ]
-    groups = list(attendance_col.aggregate(pipeline))
+    groups = list(sessions_col.aggregate(pipeline))
 
     # map batch id (string) -> batch title
-    batches_map = {}
-    for b in batches_col.find({}):
-        batches_map[str(b["_id"])] = b.get("title") or b.get("name") or str(b.get("_id"))
+    batches_map = {bid: name or bid for bid, name in refdata.names("batches").items()}
 
     return render_template('attendance_history.html',
                            groups=groups,
@@ -1447,8 +2507,8 @@ def attendance_view():
         flash("Provide both date and batch to view attendance.", "warning")
         return redirect(url_for('attendance_history'))
 
-    docs = list(attendance_col.find({"date": q_date, "batch_id": q_batch}))
-    student_ids = [d['student_id'] for d in docs]
+    statuses = load_session_statuses(q_date, q_batch)
+    student_ids = list(statuses)
 
     student_map = {}
     if student_ids:
@@ -1460,18 +2520,13 @@ def attendance_view():
             student_map = {}
 
     rows = []
-    for d in docs:
-        sid = d['student_id']
+    for sid, status in statuses.items():
         s = student_map.get(sid)
-        rows.append({"student_id": sid, "status": d.get("status", "absent"), "student": s})
+        rows.append({"student_id": sid, "status": status or "absent", "student": s})
 
     rows.sort(key=lambda r: ((r['student'] or {}).get('first_name',''), (r['student'] or {}).get('last_name','')))
 
-    try:
-        batch_doc = batches_col.find_one({"_id": ObjectId(q_batch)})
-        batch_title = batch_doc.get('name') or batch_doc.get('title') if batch_doc else q_batch
-    except Exception:
-        batch_title = q_batch
+    batch_title = refdata.names("batches").get(q_batch) or q_batch
 
     return render_template('attendance_view.html',
                            date=q_date,
@@ -1486,27 +2541,6 @@ def attendance_view():
 
 
 
-def main():
-    # find highest existing student_id (if any)
-    max_doc = students.find_one(
-        {"student_id": {"$exists": True}},
-        sort=[("student_id", -1)]
-    )
-    start = int(max_doc["student_id"]) + 1 if max_doc else 1
-
-    # find docs without student_id
-    cursor = students.find({"student_id": {"$exists": False}}).sort("_id", ASCENDING)
-    count = 0
-    for doc in cursor:
-        new_id = start + count
-        students.update_one({"_id": doc["_id"]}, {"$set": {"student_id": new_id}})
-        print(f"Assigned student_id {new_id} to {doc['_id']}")
-        count += 1
-
-    print(f"Done. Assigned student_id to {count} students. Next student_id: {start + count}")
-
-
-
 # helper: convert year,month -> start_dt, end_dt (inclusive)
 def month_date_range(year: int, month: int):
     start = datetime(year, month, 1)
@@ -1518,19 +2552,6 @@ def month_date_range(year: int, month: int):
     end = next_month - timedelta(microseconds=1)
     return start, end
 
-# helper: pick collection from globals() or fallback to db collection name
-def pick_collection(*names, fallback_name=None):
-    for n in names:
-        val = globals().get(n)
-        if val is not None:
-            return val
-    if fallback_name and globals().get("db") is not None:
-        try:
-            return globals()["db"].get_collection(fallback_name)
-        except Exception:
-            return None
-    return None
-
 
 # --------- Salary routes (paste/replace in app.py) ----------
 from flask import (
@@ -1539,23 +2560,28 @@ from flask import (
 import traceback
 
 # --- small helper: pick_collection (keeps your previous behavior if already defined) ---
+_picked_collections = {}
+
 def pick_collection(*possible_names, fallback_name=None):
     """
-    Try to return the first defined collection object from globals() by the given names.
-    If none found, try to get db[fallback_name] if db exists and fallback_name provided.
+    Return the first defined collection object from globals() by the given names,
+    else db[fallback_name]. Resolved once per argument list and then cached, so
+    salary requests don't repeat the lookup.
     """
-    db_obj = globals().get("db")
-    # first try explicitly provided names as variables in globals
+    key = (possible_names, fallback_name)
+    if key in _picked_collections:
+        return _picked_collections[key]
+    picked = None
     for nm in possible_names:
-        if nm and nm in globals() and globals()[nm] is not None:
-            return globals()[nm]
-    # fallback to db.<collection> by fallback_name
-    if db_obj is not None and fallback_name:
-        try:
-            return db_obj[fallback_name]
-        except Exception:
-            return None
-    return None
+        if nm and globals().get(nm) is not None:
+            picked = globals()[nm]
+            break
+    if picked is None and fallback_name:
+        if not schema.has(fallback_name):
+            current_app.logger.info("collection %s does not exist yet; it will be created on first write", fallback_name)
+        picked = db[fallback_name]
+    _picked_collections[key] = picked
+    return picked
 
 # --- helper: produce start/end datetimes for a given month (inclusive) ---
 def month_date_range(year: int, month: int):
@@ -1602,7 +2628,7 @@ def salary_generate():
             raw_teachers = []
             if teachers_col is not None:
                 try:
-                    raw_teachers = list(teachers_col.find({}).sort("name", 1))
+                    raw_teachers = refdata.all("faculties")
                 except Exception:
                     current_app.logger.warning("Failed to fetch teachers list", exc_info=True)
                     raw_teachers = []
@@ -1800,6 +2826,7 @@ def salary_generate():
             query_key = {"teacher_id": stored_teacher_id, "year": year, "month": month, "mode": "hours"}
             try:
                 salaries_col.update_one(query_key, {"$set": salary_doc}, upsert=True)
+                refresh_salary_rollup(year, month)
                 result["saved"] = True
             except Exception:
                 current_app.logger.exception("Failed to upsert salary_doc")
@@ -1947,6 +2974,7 @@ def salary_generate_days():
         }
 
         salaries_col.update_one(query_key, {"$set": salary_doc}, upsert=True)
+        refresh_salary_rollup(year, month)
 
         return jsonify({
             "saved": True,
@@ -2017,7 +3045,7 @@ def salary_edit(id):
             teachers = []
             if teachers_col is not None:
                 try:
-                    teachers = list(teachers_col.find({}).sort("name", 1))
+                    teachers = refdata.all("faculties")
                 except Exception:
                     teachers = []
 
@@ -2078,7 +3106,10 @@ def salary_edit(id):
         }
 
         query = {"_id": sal_obj_id} if isinstance(sal_obj_id, ObjectId) else {"_id": sal_obj_id}
-        salaries_col.update_one(query, {"$set": salary_doc})
+        old = salaries_col.find_one_and_update(query, {"$set": salary_doc}, projection={"year": 1, "month": 1})
+        if old and (old.get("year"), old.get("month")) != (year, month):
+            refresh_salary_rollup(old.get("year"), old.get("month"))
+        refresh_salary_rollup(year, month)
         flash("Salary record updated.", "success")
         return redirect(url_for('salary_list'))
 
@@ -2100,8 +3131,9 @@ def salary_delete(id):
         sal_obj_id = id
 
     try:
-        res = salaries_col.delete_one({"_id": sal_obj_id} if isinstance(sal_obj_id, ObjectId) else {"_id": sal_obj_id})
-        if res.deleted_count:
+        removed = salaries_col.find_one_and_delete({"_id": sal_obj_id}, projection={"year": 1, "month": 1})
+        if removed:
+            refresh_salary_rollup(removed.get("year"), removed.get("month"))
             flash("Salary record deleted.", "success")
         else:
             flash("Salary record not found.", "warning")
@@ -2133,7 +3165,7 @@ def debug_faculties_sample():
 def settings():
 
     users = users_col
-    user = users.find_one({"_id": session["user_id"]})
+    user = load_user(session["user_id"])
 
     if request.method == "POST":
         new_email = request.form.get("email")
@@ -2149,6 +3181,7 @@ def settings():
 
         if update_doc:
             users.update_one({"_id": user["_id"]}, {"$set": update_doc})
+            user_changed(user["_id"])
             flash("Settings updated successfully!", "success")
 
         return redirect(url_for("settings"))
@@ -2164,14 +3197,71 @@ def settings():
 
 
 
+# ---------- Current user cache ----------
+# Per-worker copy of users documents keyed by str(user id); entries live for
+# USER_CACHE_TTL seconds and are dropped by profile() / settings() writes here
+# and, through cache_sync, by writes in other workers.
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "60"))
+user_cache = TTLCache(USER_CACHE_TTL)
+
+def load_user(uid):
+    """The users document for a session user id (str or ObjectId), or None."""
+    key = str(uid)
+    u = user_cache.get(key)
+    if u is None:
+        u = get_users_col().find_one({"_id": ObjectId(key) if ObjectId.is_valid(key) else uid})
+        if u is None:
+            return None
+        user_cache.set(key, u)
+    return dict(u)
+
+
+def user_changed(uid):
+    user_cache.invalidate(str(uid))
+    log_change(db, "users", [uid])
+
+
+def sync_users(change):
+    if change is None:
+        user_cache.invalidate()
+    elif change["operationType"] == "changed":
+        for uid in change["ids"]:
+            user_cache.invalidate(str(uid))
+    else:
+        user_cache.invalidate(str(change["documentKey"]["_id"]))
+
+cache_sync.collections["users"] = sync_users
+
+# ---------- Per-worker background threads ----------
+# Started on each worker's first request, never at import: with gunicorn --preload
+# the app is imported once and forked, and threads don't survive the fork.
+_threads_pid = None
+_threads_lock = threading.Lock()
+
+@app.before_request
+def start_worker_threads():
+    global _threads_pid, cache_sync
+    if _threads_pid == os.getpid():
+        return
+    with _threads_lock:
+        if _threads_pid == os.getpid():
+            return
+        _threads_pid = os.getpid()
+        threading.Thread(target=warm_student_index, name="student-index-warmup", daemon=True).start()
+        schema.start(int(os.environ.get("SCHEMA_REFRESH_SECONDS", "300")))
+        if os.environ.get("CACHE_SYNC", "1") != "0":
+            cache_sync = cache_sync.copy()
+            refdata.watched = cache_sync   # while it runs it evicts; the per-request version check is skipped
+            cache_sync.start()
+
+
 def login_required(f):
     @wraps(f)
     def wrapped(*args, **kwargs):
         if not session.get('user_id'):
             return redirect(url_for('login', next=request.path))
-        # optionally load user into g
-        u = get_users_col().find_one({"_id": ObjectId(session['user_id'])}) if ObjectId.is_valid(str(session.get('user_id'))) else get_users_col().find_one({"_id": session.get('user_id')})
-        g.current_user = u
+        # load user into g (cached per worker, see load_user)
+        g.current_user = load_user(session['user_id'])
         return f(*args, **kwargs)
     return wrapped
 
@@ -2206,7 +3296,7 @@ def logout():
 def profile():
     users = get_users_col()
     uid = session.get('user_id')
-    user = users.find_one({"_id": ObjectId(uid)}) if ObjectId.is_valid(uid) else users.find_one({"_id": uid})
+    user = g.current_user
 
     if request.method == 'POST':
         name = request.form.get('name') or user.get('name')
@@ -2223,8 +3313,10 @@ def profile():
             dest = os.path.join(UPLOAD_FOLDER, basename)
             f.save(dest)
             update['photo'] = basename
+            photos.submit(basename)
 
         users.update_one({"_id": user.get('_id')}, {"$set": update})
+        user_changed(user.get('_id'))
         flash("Profile updated.", "success")
         return redirect(url_for('profile'))
 
@@ -2232,6 +3324,18 @@ def profile():
 
 
 
+@app.cli.command("backfill-photo-variants")
+@click.option("--force", is_flag=True, help="Regenerate variants that already exist.")
+def backfill_photo_variants_command(force):
+    """Generate thumbnail / WebP variants for photos already in the upload folder."""
+    if not photos.enabled:
+        print("❌ Pillow is not installed (pip install Pillow); nothing to do")
+        return
+    names = photos.missing(force=force)
+    done = sum(1 for name in names if photos.generate(name))
+    print(f"Photo variants written for {done} of {len(names)} uploads")
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     return send_from_directory(UPLOAD_FOLDER, filename)
@@ -2240,47 +3344,36 @@ def uploaded_file(filename):
 @app.route('/notifications')
 @login_required
 def notifications():
-    # Use the module-level students_col defined at top of file (no globals() truth testing)
-    # Fees due: student docs with 'balance' > 0
+    # Fees due: index scan on the materialized student_accounts.balance
     fees_due = []
     try:
-        for s in students_col.find({"balance": {"$gt": 0}}):
+        for a in accounts_col.find({"balance": {"$gt": 0}}).sort("balance", -1):
             fees_due.append({
                 "type": "fee",
-                "student_name": (s.get('first_name', '') + ' ' + (s.get('last_name') or '')).strip(),
-                "amount": s.get('balance'),
-                "student_id": str(s.get('_id'))
+                "student_name": a.get('student_name', ''),
+                "amount": a.get('balance'),
+                "student_id": str(a.get('_id'))
             })
     except Exception:
         fees_due = []
 
-    # Expiry alerts: expiry_date within 14 days (student.expiry_date stored as string YYYY-MM-DD or date)
+    # Expiry alerts: expiry_date (typed datetime, see refresh_expiry_dates) within 14 days
     expiry_alerts = []
     try:
         today = date.today()
-        threshold = today + timedelta(days=14)
-        for s in students_col.find({}):
-            exp = s.get('expiry_date') or s.get('expiry') or None
-            if not exp:
-                continue
-
-            # handle dates stored as string 'YYYY-MM-DD' or datetime
-            exp_date = None
-            if isinstance(exp, str):
-                try:
-                    exp_date = datetime.strptime(exp.split('T')[0], '%Y-%m-%d').date()
-                except Exception:
-                    exp_date = None
-            elif isinstance(exp, datetime):
-                exp_date = exp.date()
-
-            if exp_date and today <= exp_date <= threshold:
-                expiry_alerts.append({
-                    "type": "expiry",
-                    "student_name": (s.get('first_name', '') + ' ' + (s.get('last_name') or '')).strip(),
-                    "expiry_date": exp_date.isoformat(),
-                    "student_id": str(s.get('_id'))
-                })
+        start_dt = datetime.combine(today, datetime.min.time())
+        end_dt = datetime.combine(today + timedelta(days=14), datetime.max.time())
+        cursor = students_col.find(
+            {"expiry_date": {"$gte": start_dt, "$lte": end_dt}},
+            {"first_name": 1, "last_name": 1, "expiry_date": 1}
+        ).sort("expiry_date", 1)
+        for s in cursor:
+            expiry_alerts.append({
+                "type": "expiry",
+                "student_name": (s.get('first_name', '') + ' ' + (s.get('last_name') or '')).strip(),
+                "expiry_date": s['expiry_date'].date().isoformat(),
+                "student_id": str(s.get('_id'))
+            })
     except Exception:
         expiry_alerts = []
 
@@ -2307,115 +3400,21 @@ def notifications():
 # simple count endpoint used by navbar badge
 @app.route('/notifications/count')
 def notifications_count():
-    # Use module-level collections defined at top of file (students_col, batches_col, courses_col)
     try:
-        fees_count = students_col.count_documents({"balance": {"$gt": 0}})
+        fees_count = count_fees_due()
     except Exception:
         app.logger.exception("fees_count failed")
         fees_count = 0
 
-    expiry_count = 0
+    # expiry_date is written as a datetime on every student write (refresh_expiry_dates),
+    # so this is a single range count on the expiry_date index
     try:
         today = date.today()
-        threshold = today + timedelta(days=14)
-
-        # Fast path: try BSON datetime range count (works if expiry_date is stored as datetime)
-        try:
-            start_dt = datetime.combine(today, datetime.min.time())
-            end_dt = datetime.combine(threshold, datetime.max.time())
-            expiry_count = students_col.count_documents({
-                "expiry_date": {"$gte": start_dt, "$lte": end_dt}
-            })
-        except Exception:
-            app.logger.debug("Fast expiry_date range count failed; falling back to per-doc parsing.")
-            expiry_count = 0
-
-        # Fallback: inspect docs for string dates or infer expiry from admission_date + duration
-        if expiry_count == 0:
-            cursor = students_col.find({}, {
-                "expiry_date": 1,
-                "admission_date": 1,
-                "batch_id": 1,
-                "course_id": 1
-            })
-            for s in cursor:
-                exp = s.get("expiry_date")
-                exp_date = None
-
-                # parse expiry_date if present
-                try:
-                    if isinstance(exp, datetime):
-                        exp_date = exp.date()
-                    elif isinstance(exp, str):
-                        try:
-                            exp_date = datetime.strptime(exp[:10], "%Y-%m-%d").date()
-                        except Exception:
-                            try:
-                                exp_date = datetime.strptime(exp[:10], "%d-%m-%Y").date()
-                            except Exception:
-                                exp_date = None
-                    elif isinstance(exp, dict) and "$date" in exp:
-                        raw = exp["$date"]
-                        if isinstance(raw, str):
-                            try:
-                                exp_date = datetime.strptime(raw[:10], "%Y-%m-%d").date()
-                            except Exception:
-                                exp_date = None
-                except Exception:
-                    exp_date = None
-
-                # infer from admission_date + duration if expiry missing
-                if exp_date is None:
-                    adm = s.get("admission_date")
-                    adm_date = None
-                    if isinstance(adm, datetime):
-                        adm_date = adm.date()
-                    elif isinstance(adm, str):
-                        try:
-                            adm_date = datetime.strptime(adm[:10], "%Y-%m-%d").date()
-                        except Exception:
-                            adm_date = None
-
-                    if adm_date:
-                        dur_days = None
-                        bid = s.get("batch_id")
-                        cid = s.get("course_id")
-
-                        try:
-                            if bid:
-                                batch = batches_col.find_one({"_id": bid})
-                                if batch:
-                                    dur_days = batch.get("duration_days") or batch.get("duration")
-                                    if dur_days and isinstance(dur_days, str) and "month" in dur_days:
-                                        try:
-                                            months = int(''.join(ch for ch in dur_days if ch.isdigit()))
-                                            dur_days = months * 30
-                                        except Exception:
-                                            dur_days = None
-
-                            if dur_days is None and cid:
-                                course = courses_col.find_one({"_id": cid})
-                                if course:
-                                    dur_days = course.get("duration_days") or course.get("duration")
-                                    if dur_days and isinstance(dur_days, str) and "month" in dur_days:
-                                        try:
-                                            months = int(''.join(ch for ch in dur_days if ch.isdigit()))
-                                            dur_days = months * 30
-                                        except Exception:
-                                            dur_days = None
-                        except Exception:
-                            app.logger.debug("Failed to fetch batch/course for student %r", s.get("_id"))
-
-                        try:
-                            if dur_days:
-                                dur_days_int = int(dur_days)
-                                exp_date = adm_date + timedelta(days=dur_days_int)
-                        except Exception:
-                            exp_date = None
-
-                if exp_date and today <= exp_date <= threshold:
-                    expiry_count += 1
-
+        start_dt = datetime.combine(today, datetime.min.time())
+        end_dt = datetime.combine(today + timedelta(days=14), datetime.max.time())
+        expiry_count = students_col.count_documents({
+            "expiry_date": {"$gte": start_dt, "$lte": end_dt}
+        })
     except Exception:
         app.logger.exception("expiry_count calculation failed")
         expiry_count = 0
@@ -2433,6 +3432,8 @@ def certificate_generator_page():
     return render_template('certificate_generator.html')
 
 
+SEARCH_CANDIDATES = 500
+
 @app.route('/api/all_students')
 def api_all_students():
     """
@@ -2440,18 +3441,31 @@ def api_all_students():
     Limit and projection keep data light.
     """
     q = request.args.get('q', '').strip()
-    query = {}
-    if q:
-        # search by name or form number or phone
-        query = {"$or": [
-            {"first_name": {"$regex": q, "$options": "i"}},
-            {"last_name": {"$regex": q, "$options": "i"}},
-            {"form_no": {"$regex": q, "$options": "i"}},
-            {"phone": {"$regex": q}}
-        ]}
+    projection = {"first_name":1, "last_name":1, "form_no":1, "created_at":1}
 
-    # Adjust limit as needed
-    docs = list(db.students.find(query, {"first_name":1, "last_name":1, "form_no":1}).sort("created_at",-1).limit(200))
+    # keyset paging: ?limit=&after=/before=; neighbour tokens go in X-Next-Cursor / X-Prev-Cursor
+    after, before, per_page = keyset_args(200)
+    if request.args.get('limit'):
+        try:
+            per_page = min(max(int(request.args['limit']), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            pass
+
+    if q and student_index.ready:
+        # answered from the in-memory prefix index, no Mongo round trip
+        docs, next_token, prev_token = student_index.query(q, per_page), None, None
+    elif q:
+        # ranked search over the indexed search keys (no paging: best matches first)
+        projection.update({"search": 1, "phone": 1, "aadhar": 1, "parents_phone": 1})
+        candidates = list(db.students.find(search_filter(q), projection)
+                          .sort(keyset_sort("created_at")).limit(SEARCH_CANDIDATES))
+        candidates.sort(key=lambda s: rank(s, q), reverse=True)
+        docs, next_token, prev_token = candidates[:per_page], None, None
+    else:
+        cursor = (db.students.find(keyset_query({}, "created_at", after, before), projection)
+                  .sort(keyset_sort("created_at", before))
+                  .limit(per_page + 1))
+        docs, next_token, prev_token = keyset_page(cursor, "created_at", per_page, after, before)
     out = []
     for s in docs:
         out.append({
@@ -2459,7 +3473,12 @@ def api_all_students():
             "name": ((s.get("first_name","") + " " + s.get("last_name","")).strip()) or s.get("form_no",""),
             "form_no": s.get("form_no","")
         })
-    return jsonify(out)
+    resp = jsonify(out)
+    if next_token:
+        resp.headers["X-Next-Cursor"] = next_token
+    if prev_token:
+        resp.headers["X-Prev-Cursor"] = prev_token
+    return resp
 
 @app.route("/generate_certificate_manual", methods=["POST"])
 def generate_certificate_manual():
@@ -2526,7 +3545,7 @@ def generate_certificate(id):
         try:
             cid = student["course_id"]
             # course_id is stored as ObjectId in DB already
-            course_doc = courses_col.find_one({"_id": cid})
+            course_doc = refdata.get("courses", cid)
             if course_doc:
                 # prefer common field names
                 course = course_doc.get("name") or course_doc.get("course") or course_doc.get("title") or ""
@@ -2553,7 +3572,7 @@ def generate_certificate(id):
     if student.get("batch_id"):
         try:
             bid = student["batch_id"]
-            batch_doc = batches_col.find_one({"_id": bid})
+            batch_doc = refdata.get("batches", bid)
             if batch_doc:
                 completion = batch_doc.get("end_date") or batch_doc.get("completion_date") or batch_doc.get("finish_date") or ""
                 completion = fmt(completion)
@@ -2633,7 +3652,7 @@ def auto_allocate_contra(lines, voucher_type):
 # ----------------- Ledger Groups CRUD -----------------
 @app.route("/api/ledger_groups", methods=["GET"])
 def list_ledger_groups():
-    docs = list(db.ledger_groups.find().sort("name", 1))
+    docs = refdata.all("ledger_groups")
     out = []
     for d in docs:
         d["_id"] = str(d["_id"])
@@ -2648,6 +3667,7 @@ def create_ledger_group():
         return jsonify({"error": "name required"}), 400
     doc = {"name": name, "created_at": datetime.utcnow()}
     res = db.ledger_groups.insert_one(doc)
+    refdata.bump("ledger_groups")
     doc["_id"] = str(res.inserted_id)
     return jsonify(doc), 201
 
@@ -2658,6 +3678,7 @@ def delete_ledger_group(id):
     except Exception:
         return abort(404)
     db.ledger_groups.delete_one({"_id": oid})
+    refdata.bump("ledger_groups")
     # remove group assignment from ledgers that referenced this group (stored as string id)
     db.ledgers.update_many({"group": id}, {"$unset": {"group": ""}})
     return jsonify({"ok": True})
@@ -2666,10 +3687,8 @@ def delete_ledger_group(id):
 @app.route("/api/ledgers", methods=["GET"])
 def list_ledgers():
     docs = list(db.ledgers.find().sort("name", 1))
-    # build group map for convenience
-    group_map = {}
-    for g in db.ledger_groups.find():
-        group_map[str(g["_id"])] = g.get("name", "")
+    # group id -> name from the reference cache
+    group_map = refdata.names("ledger_groups")
     out = []
     for d in docs:
         d["_id"] = str(d["_id"])
@@ -2745,10 +3764,11 @@ def delete_ledger(id):
     return jsonify({"ok": True})
 
 # ----------------- Vouchers CRUD -----------------
-@app.route("/api/vouchers", methods=["GET"])
-def list_vouchers():
+def voucher_query(args):
+    """Mongo filter for the daybook from/to/type/search request args."""
     q = {}
-    args = request.args
+    if args.get("type"):
+        q["type"] = args.get("type")
     if args.get("from"):
         q["date"] = q.get("date", {})
         q["date"]["$gte"] = args.get("from")
@@ -2762,7 +3782,11 @@ def list_vouchers():
             {"narration": {"$regex": s, "$options":"i"}},
             {"lines.account": {"$regex": s, "$options":"i"}}
         ]
-    docs = list(db.vouchers.find(q).sort("date", 1))
+    return q
+
+@app.route("/api/vouchers", methods=["GET"])
+def list_vouchers():
+    docs = list(db.vouchers.find(voucher_query(request.args)).sort("date", 1))
     for d in docs:
         d["_id"] = str(d["_id"])
     return jsonify(docs)
@@ -2855,30 +3879,50 @@ def print_voucher(id):
 
 @app.route("/api/vouchers/export")
 def export_vouchers_csv():
-    docs = list(db.vouchers.find().sort("date", 1))
-
-    def generate():
-        # CSV header
-        yield "Date,Voucher No,Type,Debit Account,Debit Amount,Credit Account,Credit Amount,Narration\n"
-
-        for v in docs:
-            lines = v.get("lines", [])
-            dr = next((l for l in lines if l.get("type") == "debit"), {})
-            cr = next((l for l in lines if l.get("type") == "credit"), {})
-
-            yield (
-                f'{v.get("date","")},'
-                f'{v.get("no","")},'
-                f'{v.get("type","")},'
-                f'{dr.get("account","")},'
-                f'{dr.get("amount",0)},'
-                f'{cr.get("account","")},'
-                f'{cr.get("amount",0)},'
-                f'"{v.get("narration","")}"\n'
-            )
+    """
+    Streams the daybook as CSV, one row per voucher line, honouring the same
+    from/to/type/search filters as /api/vouchers. ?gzip=1 sends daybook.csv.gz.
+    """
+    cursor = db.vouchers.find(voucher_query(request.args)).sort("date", 1).batch_size(500)
+
+    def rows():
+        yield csv_line(["Date", "Voucher No", "Type", "Account", "Debit", "Credit", "Details", "Narration"])
+        for v in cursor:
+            lines = v.get("lines") or [{}]
+            for l in lines:
+                amount = l.get("amount", "")
+                yield csv_line([
+                    v.get("date", ""),
+                    v.get("no", ""),
+                    v.get("type", ""),
+                    l.get("account", ""),
+                    amount if l.get("type") == "debit" else "",
+                    amount if l.get("type") == "credit" else "",
+                    l.get("details", ""),
+                    v.get("narration", ""),
+                ])
+
+    if request.args.get("gzip") in ("1", "true"):
+        def gzipped():
+            z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+            buf = []
+            size = 0
+            for line in rows():
+                buf.append(line.encode("utf-8"))
+                size += len(buf[-1])
+                if size >= 64 * 1024:
+                    yield z.compress(b"".join(buf))
+                    buf, size = [], 0
+            yield z.compress(b"".join(buf)) + z.flush()
+
+        return Response(
+            stream_with_context(gzipped()),
+            mimetype="application/gzip",
+            headers={"Content-Disposition": "attachment; filename=daybook.csv.gz"}
+        )
 
     return Response(
-        generate(),
+        stream_with_context(rows()),
         mimetype="text/csv",
         headers={
             "Content-Disposition": "attachment; filename=daybook.csv"
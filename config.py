@@ -6,3 +6,12 @@ MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "static/uploads")
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret")
 GST_PERCENT = float(os.getenv("GST_PERCENT", "18.0"))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+
+# hi/lo counter blocks (utils.SequenceAllocator), "counter=size,...": a worker
+# reserves `size` ids per counter round trip. Unlisted counters use size 1.
+SEQUENCE_BLOCKS = {name.strip(): int(size) for name, size in
+                   (item.split("=", 1) for item in os.getenv("SEQUENCE_BLOCKS", "student_id=20").split(",") if "=" in item)}
+# receipts stay strictly gap-free (one counter step per payment, committed in the
+# same transaction as the payment where the server supports transactions)
+RECEIPT_GAPFREE = os.getenv("RECEIPT_GAPFREE", "1") == "1"
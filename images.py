@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps   # in requirements.txt; if missing, originals are served
+except ImportError:
+    Image = None
+
+# Resized variants of uploaded photos, written next to the originals:
+#   <upload folder>/thumbs/<size>/<filename>.jpg and .webp
+# keyed by the full upload name, so x.jpg and x.png never share a variant.
+# "thumb" is a square crop for list / register rows, "medium" keeps the aspect
+# ratio for profile and certificate images. Variants are generated on a small
+# thread pool after the upload is saved; photo_url() serves the WebP variant
+# once it exists and the original until then.
+SIZES = {"thumb": (128, 128), "medium": (360, 360)}
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+IMAGE_EXT = {"png", "jpg", "jpeg", "gif", "webp"}
+
+
+class PhotoVariants:
+
+    def __init__(self, folder, workers=2):
+        self.folder = folder
+        self.workers = workers
+        self._pool = None
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def path(self, filename, size, ext):
+        return os.path.join(self.folder, "thumbs", size, f"{filename}.{ext}")
+
+    def url_path(self, filename, size="thumb"):
+        """Path under the upload folder to serve for `filename` at `size` (webp, else original)."""
+        if size in SIZES and os.path.exists(self.path(filename, size, "webp")):
+            return f"thumbs/{size}/{filename}.webp"
+        return filename
+
+    def generate(self, filename):
+        """Write every size of one upload (overwriting); returns False if it can't be read."""
+        if not self.enabled:
+            return False
+        try:
+            with Image.open(os.path.join(self.folder, filename)) as im:
+                im = ImageOps.exif_transpose(im)   # phone photos are often rotated via EXIF
+                im = im.convert("RGB")
+                for size, box in SIZES.items():
+                    if size == "thumb":
+                        out = ImageOps.fit(im, box, Image.LANCZOS)
+                    else:
+                        out = im.copy()
+                        out.thumbnail(box, Image.LANCZOS)
+                    os.makedirs(os.path.dirname(self.path(filename, size, "jpg")), exist_ok=True)
+                    out.save(self.path(filename, size, "jpg"), "JPEG", quality=JPEG_QUALITY, optimize=True)
+                    out.save(self.path(filename, size, "webp"), "WEBP", quality=WEBP_QUALITY, method=4)
+            return True
+        except (OSError, ValueError) as e:
+            print(f"❌ Photo variants for {filename} failed:", e)
+            return False
+
+    def submit(self, filename):
+        """Queue variant generation for a freshly saved upload."""
+        self.discard(filename)   # a re-upload under the same name must not show the old photo
+        if not self.enabled or not filename:
+            return None
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="photo-variants")
+        return self._pool.submit(self.generate, filename)
+
+    def discard(self, filename):
+        if not filename:
+            return
+        for size in SIZES:
+            for ext in ("jpg", "webp"):
+                try:
+                    os.remove(self.path(filename, size, ext))
+                except FileNotFoundError:
+                    pass
+
+    def missing(self, force=False):
+        """Upload filenames (top level only) that have no variants yet, or all with force."""
+        out = []
+        for name in sorted(os.listdir(self.folder)):
+            full = os.path.join(self.folder, name)
+            if not os.path.isfile(full) or name.rsplit(".", 1)[-1].lower() not in IMAGE_EXT:
+                continue
+            if force or not all(os.path.exists(self.path(name, s, "webp")) for s in SIZES):
+                out.append(name)
+        return out
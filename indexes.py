@@ -0,0 +1,99 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Every index the app relies on, per collection. Names are fixed so that
+# ensure_indexes() is idempotent and the report can match them up.
+# Unique indexes are partial so legacy documents missing the key don't collide.
+INDEXES = {
+    "students": [
+        IndexModel([("form_no", ASCENDING)], name="form_no_unique", unique=True,
+                   partialFilterExpression={"form_no": {"$type": "string"}}),
+        IndexModel([("batch_id", ASCENDING)], name="batch_id"),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+        IndexModel([("expiry_date", ASCENDING)], name="expiry_date"),
+        IndexModel([("search.names", ASCENDING)], name="search_names"),
+        IndexModel([("search.rev", ASCENDING)], name="search_rev"),
+    ],
+    "payments": [
+        IndexModel([("student_id", ASCENDING), ("date", DESCENDING)], name="student_id_date"),
+        IndexModel([("date", DESCENDING)], name="date"),
+        IndexModel([("receipt_no", ASCENDING)], name="receipt_no_unique", unique=True,
+                   partialFilterExpression={"receipt_no": {"$exists": True}}),
+        IndexModel([("receipt_seq", ASCENDING)], name="receipt_seq_unique", unique=True,
+                   partialFilterExpression={"receipt_seq": {"$type": "number"}}),
+    ],
+    "attendance": [
+        IndexModel([("date", ASCENDING), ("batch_id", ASCENDING), ("student_id", ASCENDING)],
+                   name="date_batch_student_unique", unique=True,
+                   partialFilterExpression={"student_id": {"$exists": True}}),
+    ],
+    "attendance_sessions": [
+        IndexModel([("batch_id", ASCENDING), ("date", ASCENDING)], name="batch_date_unique", unique=True),
+        IndexModel([("date", DESCENDING)], name="date"),
+    ],
+    "salaries": [
+        IndexModel([("teacher_id", ASCENDING), ("year", ASCENDING), ("month", ASCENDING), ("mode", ASCENDING)],
+                   name="teacher_year_month_mode"),
+    ],
+    "vouchers": [
+        IndexModel([("date", ASCENDING)], name="date"),
+    ],
+    "cache_changes": [
+        IndexModel([("kind", ASCENDING), ("v", ASCENDING)], name="kind_v"),
+        IndexModel([("at", ASCENDING)], name="at_ttl", expireAfterSeconds=86400),
+    ],
+    "student_accounts": [
+        IndexModel([("balance", DESCENDING)], name="balance"),
+        IndexModel([("course_id", ASCENDING)], name="course_id"),
+    ],
+}
+
+
+def _key(spec):
+    return tuple((k, int(v) if isinstance(v, (int, float)) else v) for k, v in spec)
+
+
+def ensure_indexes(db, collections=None):
+    """
+    Create the declared indexes (no-op for ones that already exist).
+    Returns {collection: [error strings]}; a failure (e.g. duplicates blocking a
+    unique index) is reported instead of raised so startup is never blocked.
+    """
+    errors = {}
+    for coll, models in INDEXES.items():
+        if collections and coll not in collections:
+            continue
+        for model in models:
+            try:
+                db[coll].create_indexes([model])
+            except OperationFailure as e:
+                errors.setdefault(coll, []).append(f"{model.document['name']}: {e}")
+    return errors
+
+
+def index_report(db):
+    """
+    Compare declared indexes with the server.
+    Returns {collection: {"missing": [...], "extra": [...], "unused": [...]}} where
+    unused lists existing indexes with zero accesses since the last server restart.
+    """
+    report = {}
+    for coll, models in INDEXES.items():
+        declared = {_key(m.document["key"].items()): m.document["name"] for m in models}
+        existing = {}
+        for ix in db[coll].list_indexes():
+            existing[_key(ix["key"].items())] = ix["name"]
+
+        usage = {}
+        try:
+            for st in db[coll].aggregate([{"$indexStats": {}}]):
+                usage[st["name"]] = st.get("accesses", {}).get("ops", 0)
+        except OperationFailure:
+            usage = {}
+
+        report[coll] = {
+            "missing": [name for key, name in declared.items() if key not in existing],
+            "extra": [name for key, name in existing.items() if key not in declared and name != "_id_"],
+            "unused": [name for name, ops in usage.items() if ops == 0 and name != "_id_"],
+        }
+    return report
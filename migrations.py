@@ -0,0 +1,115 @@
+from datetime import datetime
+from pymongo import UpdateOne
+
+from utils import reserve_sequence
+
+# Resumable data migrations. A migration streams the documents matching a query
+# in _id order, batch_size at a time, and applies one bulk_write per batch.
+# Progress is checkpointed in db.migrations ({"_id": name, ...}):
+#   state     - "running" | "done"
+#   total     - documents matched when the run started (the run never goes past it)
+#   position  - documents handled so far; build_op() gets each document's position
+#   last_id   - _id of the last handled document
+#   pending   - _ids of the batch being applied, written before the bulk_write
+#   data      - whatever prepare() returned on the first run (e.g. a reserved range)
+# After an interruption the pending batch is re-applied at the same positions,
+# so build_op() must return idempotent ops (filter on the query condition).
+
+
+def run_migration(db, name, collection, query, build_op, batch_size=1000,
+                  prepare=None, restart=False, log=print):
+    """
+    Run (or resume) the migration `name` over collection.find(query).
+    build_op(doc, position, data) -> a pymongo write op, or None to skip.
+    prepare(total) -> dict stored as `data`; called once, on the first run only.
+    Returns the final checkpoint document.
+    """
+    state = db.migrations.find_one({"_id": name})
+    if state and restart:
+        db.migrations.delete_one({"_id": name})
+        state = None
+    if state and state.get("state") == "done":
+        return state
+    if not state:
+        total = collection.count_documents(query)
+        state = {
+            "_id": name, "state": "running", "total": total, "position": 0,
+            "last_id": None, "pending": [],
+            "data": prepare(total) if prepare else {},
+            "started_at": datetime.utcnow(), "updated_at": datetime.utcnow(),
+        }
+        db.migrations.insert_one(state)
+    else:
+        log(f"{name}: resuming at {state['position']}/{state['total']}")
+
+    while True:
+        pending = state.get("pending") or []
+        if pending:
+            _apply(collection, pending, state, build_op)
+            state["position"] += len(pending)
+            state["last_id"] = pending[-1]
+            state["pending"] = []
+            _save(db, state, "position", "last_id", "pending")
+            log(f"{name}: {state['position']}/{state['total']}")
+            continue
+
+        left = state["total"] - state["position"]
+        if left <= 0:
+            break
+        after = {"_id": {"$gt": state["last_id"]}} if state["last_id"] is not None else {}
+        ids = [d["_id"] for d in collection.find({"$and": [query, after]}, {"_id": 1})
+                                           .sort("_id", 1).limit(min(batch_size, left))]
+        if not ids:
+            break
+        state["pending"] = ids
+        _save(db, state, "pending")
+
+    state["state"] = "done"
+    state["remaining"] = collection.count_documents(query)
+    _save(db, state, "state", "remaining")
+    return state
+
+
+def _apply(collection, ids, state, build_op):
+    docs = {d["_id"]: d for d in collection.find({"_id": {"$in": ids}})}
+    ops = []
+    for i, _id in enumerate(ids):
+        if _id in docs:   # deleted since the batch was picked: its position is skipped
+            op = build_op(docs[_id], state["position"] + i, state["data"])
+            if op is not None:
+                ops.append(op)
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+
+
+def _save(db, state, *fields):
+    state["updated_at"] = datetime.utcnow()
+    db.migrations.update_one({"_id": state["_id"]},
+                             {"$set": {f: state[f] for f in fields + ("updated_at",)}})
+
+
+def backfill_student_ids(db, batch_size=1000, restart=False, log=print):
+    """
+    Give every student without a student_id the next counter value, in _id order.
+    The whole range is reserved with one counter update on the first run.
+    """
+    missing = {"student_id": {"$exists": False}}
+
+    def prepare(total):
+        # the counter must start above ids assigned by older code (max + 1 scheme)
+        top = db.students.find_one({"student_id": {"$exists": True}}, {"student_id": 1},
+                                   sort=[("student_id", -1)])
+        if top:
+            db.counters.update_one({"_id": "student_id"},
+                                   {"$max": {"seq": int(top["student_id"])}}, upsert=True)
+        if not total:
+            return {"first": None, "last": None}
+        first, last = reserve_sequence(db, "student_id", total)
+        return {"first": first, "last": last}
+
+    def build_op(doc, position, data):
+        return UpdateOne({"_id": doc["_id"], **missing},
+                         {"$set": {"student_id": data["first"] + position}})
+
+    return run_migration(db, "backfill_student_ids", db.students, missing, build_op,
+                         batch_size=batch_size, prepare=prepare, restart=restart, log=log)
@@ -0,0 +1,323 @@
+import time
+import threading
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from refsnapshot import SnapshotReader, write_snapshot
+
+# Small reference collections served from memory, with the order their
+# dropdowns / lists use.
+REFERENCE_KINDS = {
+    "courses": [("name", 1)],
+    "batches": [("start_date", -1)],
+    "faculties": [("name", 1)],
+    "ledger_groups": [("name", 1)],
+}
+
+
+def bump_version(db, kind):
+    """Increment cache_versions[kind]; returns the new version."""
+    doc = db.cache_versions.find_one_and_update(
+        {"_id": kind}, {"$inc": {"v": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    return doc["v"]
+
+
+def log_change(db, kind, ids=None):
+    """
+    Bump cache_versions[kind] and record which documents the write touched in
+    cache_changes ({kind, v, ids, at}), so a polling CacheSync can apply just
+    those. ids=None means "unknown": pollers reload the whole cache for it.
+    """
+    v = bump_version(db, kind)
+    db.cache_changes.insert_one({"kind": kind, "v": v, "at": datetime.utcnow(),
+                                 "ids": list(ids) if ids is not None else None})
+    return v
+
+
+class _MemorySnapshot:
+    """In-process stand-in for refsnapshot.Snapshot when no shared file is configured."""
+
+    def __init__(self, versions, kinds):
+        self.versions = versions
+        self._docs = kinds
+        self._by_id = {k: {str(d["_id"]): d for d in docs} for k, docs in kinds.items()}
+        self._names = {k: {i: d.get("name") or d.get("title") or "" for i, d in by_id.items()}
+                       for k, by_id in self._by_id.items()}
+
+    def all(self, kind):
+        return [dict(d) for d in self._docs.get(kind, [])]
+
+    def get(self, kind, _id):
+        d = self._by_id.get(kind, {}).get(str(_id)) if _id is not None else None
+        return dict(d) if d else None
+
+    def names(self, kind):
+        return self._names.get(kind, {})
+
+
+class ReferenceCache:
+    """
+    Read-through cache of the reference collections. Every kind has a version
+    counter in cache_versions ({"_id": kind, "v": n}); CRUD routes call bump(kind)
+    and a kind is re-read once the stored version differs from the one the
+    current snapshot was built at. The version lookup is throttled to one query per
+    check_interval seconds. `watched` is the CacheSync thread feeding versions in
+    through evict(); the per-request check is skipped only while it is alive (a
+    forked worker inherits the object but not the thread).
+
+    With snapshot_path set, the data lives in a memory-mapped snapshot file
+    (refsnapshot.py) shared by every worker on the node: whichever worker first
+    needs a newer version rebuilds and atomically replaces it, the others remap.
+    """
+
+    def __init__(self, db, check_interval=5, snapshot_path=None):
+        self.db = db
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._versions = {}  # kind -> latest version seen
+        self._checked = 0.0
+        self._reader = SnapshotReader(snapshot_path) if snapshot_path else None
+        self._snap = None    # in-memory snapshot (no shared file, or writing it failed)
+        self.watched = None   # CacheSync thread, set by the app
+
+    def _check_versions(self):
+        now = time.monotonic()
+        watched = self.watched is not None and self.watched.is_alive()
+        if self._checked and (watched or now - self._checked < self.check_interval):
+            return
+        self._checked = now
+        for d in self.db.cache_versions.find({"_id": {"$in": list(REFERENCE_KINDS)}}):
+            self._versions[d["_id"]] = max(d.get("v", 0), self._versions.get(d["_id"], 0))
+
+    def bump(self, kind):
+        """Record a write to `kind`: new version in the database and locally."""
+        self.evict(kind, bump_version(self.db, kind))
+
+    def evict(self, kind, version):
+        """Note that `kind` is now at `version`; older snapshots stop being served."""
+        with self._lock:
+            self._versions[kind] = max(version, self._versions.get(kind, 0))
+
+    def _current(self, kind):
+        with self._lock:
+            self._check_versions()
+            wanted = self._versions.get(kind, 0)
+            # exact match: a file left from a reset / restored database never passes
+            for snap in (self._reader.current() if self._reader else None, self._snap):
+                if snap is not None and snap.versions.get(kind, -1) == wanted:
+                    return snap
+        return self._load()
+
+    def _load(self):
+        """Read every kind (versions first, so no data is labelled newer than it is)."""
+        versions = dict.fromkeys(REFERENCE_KINDS, 0)
+        for d in self.db.cache_versions.find({"_id": {"$in": list(REFERENCE_KINDS)}}):
+            versions[d["_id"]] = d.get("v", 0)
+        kinds = {k: list(self.db[k].find().sort(order)) for k, order in REFERENCE_KINDS.items()}
+
+        snap = None
+        if self._reader:
+            try:
+                write_snapshot(self._reader.path, versions, kinds)
+                snap = self._reader.current()
+            except OSError as e:
+                print("❌ Reference snapshot write failed:", e)
+        with self._lock:
+            for k, v in versions.items():
+                self._versions[k] = max(v, self._versions.get(k, 0))
+            if snap is None:
+                snap = self._snap = _MemorySnapshot(versions, kinds)
+        return snap
+
+    def all(self, kind):
+        """Every document of `kind` as fresh dicts, in dropdown order (safe to mutate)."""
+        return self._current(kind).all(kind)
+
+    def get(self, kind, _id):
+        """One document by ObjectId or its string form; None if unknown."""
+        if _id is None:
+            return None
+        return self._current(kind).get(kind, _id)
+
+    def names(self, kind):
+        """{str id: display name (name, else title)} for `kind`."""
+        return self._current(kind).names(kind)
+
+
+class CacheSync(threading.Thread):
+    """
+    Per-worker background thread that keeps in-process caches in step with writes
+    made by other workers.
+
+    versions:    {kind: callback(version)} - driven by the kind's cache_versions
+                 document, so the callback sees the bumped version number.
+    collections: {collection: callback(change)} - driven by the collection itself;
+                 callback gets the change event (fullDocument included), a
+                 {"operationType": "changed", "ids": [...]} batch while polling,
+                 or None when only "something changed" is known.
+
+    It tails one change stream for both; where change streams are not available
+    (standalone mongod, or the schema registry says no) it polls cache_versions
+    every poll_interval seconds and reads the touched _ids from cache_changes,
+    so writers to `collections` must always log_change() them (another worker
+    may be polling even while this one streams).
+    streams may be a callable (re-asked every poll tick); after the server
+    refuses a change stream it is not retried for stream_retry seconds.
+    on_mode(mode) is told "stream" or "poll" whenever the mode is (re)chosen.
+    """
+
+    def __init__(self, db, versions=None, collections=None, poll_interval=5, streams=True,
+                 on_mode=None, stream_retry=300):
+        super().__init__(name="cache-sync", daemon=True)
+        self.db = db
+        self.versions = versions or {}
+        self.collections = collections or {}
+        self.poll_interval = poll_interval
+        self.streams = streams
+        self.on_mode = on_mode
+        self.stream_retry = stream_retry
+        self.mode = None
+        self._halt = threading.Event()
+        self._resume_token = None
+        self._no_streams_until = 0.0
+        self._seen = None       # versions seen by the last poll, replayed when a stream opens
+        self._deferred = set()  # names whose cache_changes entries were not written yet
+
+    def copy(self):
+        """
+        An unstarted CacheSync with the same settings. A thread starts only once, and
+        one created before a fork never reports alive in the child, so each worker
+        starts its own copy.
+        """
+        return CacheSync(self.db, versions=self.versions, collections=self.collections,
+                         poll_interval=self.poll_interval, streams=self.streams,
+                         on_mode=self.on_mode, stream_retry=self.stream_retry)
+
+    def _use_streams(self):
+        if time.monotonic() < self._no_streams_until:
+            return False
+        return bool(self.streams() if callable(self.streams) else self.streams)
+
+    def stop(self):
+        self._halt.set()
+
+    def _set_mode(self, mode):
+        if mode != self.mode:
+            self.mode = mode
+            if self.on_mode:
+                self.on_mode(mode)
+
+    def _dispatch(self, name, arg):
+        handler = self.versions.get(name) or self.collections.get(name)
+        try:
+            handler(arg)
+        except Exception as e:
+            print(f"❌ cache-sync handler for {name} failed:", e)
+
+    def _stream(self):
+        pipeline = [{"$match": {"$or": [
+            {"ns.coll": "cache_versions", "documentKey._id": {"$in": list(self.versions)}},
+            {"ns.coll": {"$in": list(self.collections)}},
+        ]}}]
+        with self.db.watch(pipeline, full_document="updateLookup",
+                           resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+            self._set_mode("stream")
+            if self._seen is not None:
+                # coming from polling: catch up on writes made before the stream opened
+                self._resync(self._seen)
+                self._seen = None
+            while not self._halt.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self._resume_token = stream.resume_token
+                if change.get("operationType") == "invalidate":
+                    return
+                if change["ns"]["coll"] == "cache_versions":
+                    version = (change.get("fullDocument") or {}).get("v")
+                    if version is not None:
+                        self._dispatch(change["documentKey"]["_id"], version)
+                else:
+                    self._dispatch(change["ns"]["coll"], change)
+
+    def _current_versions(self):
+        names = list(self.versions) + list(self.collections)
+        return {d["_id"]: d.get("v", 0) for d in self.db.cache_versions.find({"_id": {"$in": names}})}
+
+    def _changed_ids(self, name, since, until):
+        """
+        _ids logged in cache_changes for versions (since, until]; None when the
+        log can't say (a write without ids, expired entries), False when entries
+        are still missing for the first time (written right after the bump).
+        """
+        if until < since:
+            return None   # version went backwards: database reset / restored
+        ids, versions = [], set()
+        for d in self.db.cache_changes.find({"kind": name, "v": {"$gt": since, "$lte": until}}):
+            if d.get("ids") is None:
+                return None
+            versions.add(d["v"])
+            ids.extend(d["ids"])
+        if len(versions) < until - since:
+            if name in self._deferred:
+                return None
+            self._deferred.add(name)
+            return False
+        return list(dict.fromkeys(ids))
+
+    def _resync(self, seen=None):
+        """Dispatch every name whose version differs from `seen` (all of them when None)."""
+        current = self._current_versions()
+        for name in list(self.versions) + list(self.collections):
+            v = current.get(name, 0)
+            if seen is not None and seen.get(name, 0) == v:
+                continue
+            if name in self.versions:
+                self._dispatch(name, v)
+                continue
+            ids = self._changed_ids(name, seen.get(name, 0), v) if seen is not None else None
+            if ids is False:
+                current[name] = seen.get(name, 0)   # look again next tick
+                continue
+            self._deferred.discard(name)
+            if ids is None:
+                self._dispatch(name, None)
+            elif ids:
+                self._dispatch(name, {"operationType": "changed", "ns": {"coll": name}, "ids": ids})
+        return current
+
+    def _poll(self):
+        self._set_mode("poll")
+        self._seen = self._current_versions()
+        while not self._halt.wait(self.poll_interval):
+            self._seen = self._resync(self._seen)
+            if self._use_streams():
+                return   # streams available again (schema refresh / retry window over)
+
+    def run(self):
+        while not self._halt.is_set():
+            if not self._use_streams():
+                try:
+                    self._poll()
+                except PyMongoError as e:
+                    print("❌ cache-sync polling failed:", e)
+                    self._halt.wait(self.poll_interval)
+                continue
+            try:
+                self._stream()
+            except (PyMongoError, NotImplementedError) as e:
+                code = getattr(e, "code", None)
+                if code in (40573, 136) or isinstance(e, NotImplementedError):
+                    # change streams unsupported here (standalone / disabled): poll for a while
+                    self._no_streams_until = time.monotonic() + self.stream_retry
+                    continue
+                print("❌ cache-sync change stream error:", e)
+                if code == 286:
+                    # resume point fell off the oplog: changes were missed, resync everything
+                    self._resume_token = None
+                    try:
+                        self._resync()
+                    except PyMongoError:
+                        pass
+                self._halt.wait(self.poll_interval)
@@ -0,0 +1,151 @@
+import os
+import mmap
+import bisect
+import struct
+
+import bson
+from bson.objectid import ObjectId
+
+# Binary reference snapshot shared by every worker on a node.
+#
+#   MAGIC | u32 header length | header (BSON) | per kind: docs section, index section
+#
+# header = {"versions": {kind: v}, "kinds": {kind: {"docs": [start, end],
+#           "index": [start, count]}}}
+# The docs section is the kind's BSON documents back to back, in dropdown order.
+# The index section is `count` fixed-size records (12-byte ObjectId, u32 offset,
+# u32 length) sorted by id, so a lookup is a binary search over the mapping.
+# Files are written to a temp name and os.replace()d into place; readers remap
+# when the file identity changes and old mappings stay valid until dropped.
+
+MAGIC = b"RDSNAP1\0"
+HEAD = struct.Struct("<I")
+RECORD = struct.Struct("<12sII")
+
+
+def write_snapshot(path, versions, kinds):
+    """Atomically replace the snapshot at path with {kind: [docs]} at `versions`."""
+    body = bytearray()
+    sections = []
+    for kind, docs in kinds.items():
+        blobs = [bson.encode(d) for d in docs]
+        records = []
+        offset = 0
+        for d, blob in zip(docs, blobs):
+            if isinstance(d.get("_id"), ObjectId):
+                records.append((d["_id"].binary, offset, len(blob)))
+            offset += len(blob)
+        records.sort()
+        sections.append((kind, b"".join(blobs), records))
+
+    # the header holds absolute offsets, which depend on the header's own length
+    def header_for(base):
+        pos = base
+        out = {}
+        for kind, docs_blob, records in sections:
+            out[kind] = {"docs": [pos, pos + len(docs_blob)], "index": [pos + len(docs_blob), len(records)]}
+            pos += len(docs_blob) + RECORD.size * len(records)
+        return bson.encode({"versions": versions, "kinds": out})
+
+    base = len(MAGIC) + HEAD.size
+    header = header_for(base)
+    while True:   # offsets depend on the header's own length; settle on a fixed point
+        again = header_for(base + len(header))
+        if len(again) == len(header):
+            header = again
+            break
+        header = again
+    for kind, docs_blob, records in sections:
+        start = base + len(header) + len(body)
+        body += docs_blob
+        for oid, off, length in records:
+            body += RECORD.pack(oid, start + off, length)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + HEAD.pack(len(header)) + header + bytes(body))
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    """Read-only view over one mapped snapshot file."""
+
+    def __init__(self, fileobj):
+        self._mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a reference snapshot")
+        start = len(MAGIC) + HEAD.size
+        (size,) = HEAD.unpack_from(self._mm, len(MAGIC))
+        header = bson.decode(self._mm[start:start + size])
+        self.versions = header["versions"]
+        self._kinds = header["kinds"]
+        self._names = {}
+
+    def all(self, kind):
+        meta = self._kinds.get(kind)
+        if not meta:
+            return []
+        start, end = meta["docs"]
+        return bson.decode_all(self._mm[start:end])
+
+    def get(self, kind, _id):
+        meta = self._kinds.get(kind)
+        if not meta or _id is None:
+            return None
+        try:
+            key = (_id if isinstance(_id, ObjectId) else ObjectId(str(_id))).binary
+        except Exception:
+            # only ObjectId keys are indexed; anything else is a scan of the kind
+            return next((d for d in self.all(kind) if str(d["_id"]) == str(_id)), None)
+        start, count = meta["index"]
+        keys = _RecordKeys(self._mm, start, count)
+        i = bisect.bisect_left(keys, key)
+        if i == count or keys[i] != key:
+            return None
+        _, off, length = RECORD.unpack_from(self._mm, start + i * RECORD.size)
+        return bson.decode(self._mm[off:off + length])
+
+    def names(self, kind):
+        # decoded once per mapping; the documents themselves stay in the shared pages
+        if kind not in self._names:
+            self._names[kind] = {str(d["_id"]): d.get("name") or d.get("title") or ""
+                                 for d in self.all(kind)}
+        return self._names[kind]
+
+
+class _RecordKeys:
+    """Sequence view of the sorted index keys, for bisect."""
+
+    def __init__(self, mm, start, count):
+        self.mm, self.start, self.count = mm, start, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        pos = self.start + i * RECORD.size
+        return self.mm[pos:pos + 12]
+
+
+class SnapshotReader:
+    """Keeps the current snapshot at `path` mapped, remapping after it is replaced."""
+
+    def __init__(self, path):
+        self.path = path
+        self._ident = None
+        self._snap = None
+
+    def current(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        ident = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if ident != self._ident:
+            try:
+                with open(self.path, "rb") as f:
+                    self._snap = Snapshot(f)
+                self._ident = ident
+            except (OSError, ValueError):
+                return None
+        return self._snap
@@ -0,0 +1,75 @@
+import threading
+from pymongo.errors import PyMongoError
+
+
+class SchemaRegistry:
+    """
+    What the database looks like, discovered once and refreshed in the background:
+    the collections that exist, their indexes ({collection: {name: key}}), and
+    server capabilities (replica set / sharded, transactions, change streams,
+    time-series collections). Routes read these attributes instead of issuing
+    list_collection_names() / listIndexes / hello on the request path.
+    """
+
+    def __init__(self, client, db):
+        self.client = client
+        self.db = db
+        self.collections = frozenset()
+        self.indexes = {}
+        self.capabilities = {}
+        self._halt = threading.Event()
+
+    def refresh(self):
+        """Re-read collections, indexes and capabilities; errors leave the old values."""
+        try:
+            names = self.db.list_collection_names()
+            indexes = {}
+            for name in names:
+                indexes[name] = {ix["name"]: dict(ix["key"]) for ix in self.db[name].list_indexes()}
+            self.collections, self.indexes = frozenset(names), indexes
+        except PyMongoError as e:
+            print("❌ Schema refresh (collections) failed:", e)
+        try:
+            self.capabilities = self._probe_capabilities()
+        except PyMongoError as e:
+            print("❌ Schema refresh (capabilities) failed:", e)
+        return self
+
+    def _probe_capabilities(self):
+        try:
+            hello = self.client.admin.command("hello")
+        except PyMongoError:
+            hello = self.client.admin.command("isMaster")   # servers before 4.4.2
+        build = self.client.admin.command("buildInfo")
+        version = tuple((list(build.get("versionArray") or []) + [0, 0, 0])[:3])
+        replica_set = "setName" in hello
+        sharded = hello.get("msg") == "isdbgrid"
+        sessions = "logicalSessionTimeoutMinutes" in hello
+        return {
+            "version": ".".join(str(v) for v in version),
+            "replica_set": replica_set,
+            "sharded": sharded,
+            "change_streams": (replica_set or sharded) and version >= (3, 6),
+            "transactions": sessions and ((replica_set and version >= (4, 0)) or
+                                          (sharded and version >= (4, 2))),
+            "time_series": version >= (5, 0),
+        }
+
+    def has(self, name):
+        return name in self.collections
+
+    def supports(self, capability):
+        return bool(self.capabilities.get(capability))
+
+    def index_names(self, collection):
+        return set(self.indexes.get(collection, {}))
+
+    def start(self, interval):
+        """Refresh every `interval` seconds on a daemon thread."""
+        def loop():
+            while not self._halt.wait(interval):
+                self.refresh()
+        threading.Thread(target=loop, name="schema-refresh", daemon=True).start()
+
+    def stop(self):
+        self._halt.set()
@@ -0,0 +1,225 @@
+import re
+import bisect
+import threading
+import unicodedata
+from datetime import datetime
+
+# Students carry a normalized "search" sub-document, written on every insert/update:
+#   search.names - lowercased name tokens (first, last, father) for prefix matching
+#   search.rev   - reversed phone / parents_phone / aadhar digits and form_no, so a
+#                  suffix (or exact) match is an anchored prefix regex on an index
+# Both are multikey-indexed (see indexes.py), so every lookup is an index scan.
+
+NAME_FIELDS = ("first_name", "last_name", "father_name")
+NUMBER_FIELDS = ("phone", "parents_phone", "aadhar")
+MIN_SUFFIX = 3
+PHONE_SEPARATORS = set("+-().")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return text.casefold().strip()
+
+
+def digits(text):
+    return "".join(ch for ch in str(text or "") if ch.isdigit())
+
+
+def query_tails(whole):
+    """
+    Values a query (spaces removed) is matched against search.rev: itself, plus
+    its bare digits when it is a number written with separators ("98765-43210").
+    A query with letters ("A001") never falls back to its digits.
+    """
+    tails = {whole} if whole else set()
+    if any(ch.isdigit() for ch in whole) and all(ch.isdigit() or ch in PHONE_SEPARATORS for ch in whole):
+        tails.add(digits(whole))
+    return tails
+
+
+def search_keys(student):
+    """The 'search' sub-document for a student dict."""
+    names = []
+    for f in NAME_FIELDS:
+        for tok in normalize(student.get(f)).split():
+            if tok not in names:
+                names.append(tok)
+    rev = []
+    for f in NUMBER_FIELDS:
+        d = digits(student.get(f))
+        if d and d[::-1] not in rev:
+            rev.append(d[::-1])
+    form_no = normalize(student.get("form_no"))
+    if form_no and form_no[::-1] not in rev:
+        rev.append(form_no[::-1])
+    return {"names": names, "rev": rev}
+
+
+def search_filter(q):
+    """
+    Mongo filter for a free-text query: every word must prefix a name token, or
+    the whole query must be the tail (or all) of a phone / aadhar / form_no.
+    Queries shorter than MIN_SUFFIX only match numbers exactly.
+    """
+    qn = normalize(q)
+    tokens = qn.split()
+    if not tokens:
+        return {}
+    clauses = [{"$and": [{"search.names": {"$regex": "^" + re.escape(t)}} for t in tokens]}]
+    whole = qn.replace(" ", "")
+    for tail in query_tails(whole):
+        if len(tail) >= MIN_SUFFIX:
+            clauses.append({"search.rev": {"$regex": "^" + re.escape(tail[::-1])}})
+        else:
+            clauses.append({"search.rev": tail[::-1]})
+    return {"$or": clauses}
+
+
+def rank(student, q):
+    """Relevance score for a matched student (higher first)."""
+    qn = normalize(q)
+    tokens = qn.split()
+    if not tokens:
+        return 0
+    whole = qn.replace(" ", "")
+    tails = query_tails(whole)
+    keys = student.get("search") or search_keys(student)
+
+    score = 0
+    for r in keys.get("rev", []):
+        value = r[::-1]
+        if value in tails:
+            score = max(score, 100)
+        elif any(value.endswith(t) for t in tails):
+            score = max(score, 60)
+
+    names = keys.get("names", [])
+    first = normalize(student.get("first_name"))
+    full = " ".join(t for t in (first, normalize(student.get("last_name"))) if t)
+    if full == qn:
+        score = max(score, 90)
+    elif all(t in names for t in tokens):
+        score = max(score, 85)
+    elif full.startswith(qn):
+        score = max(score, 80)
+    elif first.startswith(tokens[0]):
+        score = max(score, 70)
+    elif all(any(n.startswith(t) for n in names) for t in tokens):
+        score = max(score, 50)
+    return score
+
+
+class PrefixIndex:
+    """
+    Per-process autocomplete index: two sorted arrays of (key, id) pairs, one over
+    name tokens and form_no, one over reversed numbers (search.rev), so prefix
+    and suffix lookups are a bisect plus a short scan. Kept in sync by upsert()
+    and remove() on student writes; load() warms it from a students cursor.
+    """
+
+    FIELDS = {"first_name": 1, "last_name": 1, "father_name": 1, "form_no": 1,
+              "phone": 1, "parents_phone": 1, "aadhar": 1, "created_at": 1}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._names = []
+        self._rev = []
+        self._pending = []  # writes seen while load() is still reading
+        self.ready = False
+
+    @staticmethod
+    def _entry(doc):
+        keys = search_keys(doc)
+        entry = {
+            "_id": doc["_id"],
+            "first_name": doc.get("first_name") or "",
+            "last_name": doc.get("last_name") or "",
+            "form_no": doc.get("form_no") or "",
+            "created_at": doc.get("created_at"),
+            "search": keys,
+        }
+        form_no = normalize(doc.get("form_no"))
+        names = keys["names"] + ([form_no] if form_no and form_no not in keys["names"] else [])
+        return entry, names, keys["rev"]
+
+    def _drop(self, sid):
+        old = self._docs.pop(sid, None)
+        if old is None:
+            return
+        for arr, keys in ((self._names, old["_name_keys"]), (self._rev, old["search"]["rev"])):
+            for k in keys:
+                i = bisect.bisect_left(arr, (k, sid))
+                if i < len(arr) and arr[i] == (k, sid):
+                    del arr[i]
+
+    def load(self, docs):
+        docs_map, names, rev = {}, [], []
+        for doc in docs:
+            entry, name_keys, rev_keys = self._entry(doc)
+            entry["_name_keys"] = name_keys
+            docs_map[doc["_id"]] = entry
+            names.extend((k, doc["_id"]) for k in name_keys)
+            rev.extend((k, doc["_id"]) for k in rev_keys)
+        names.sort()
+        rev.sort()
+        with self._lock:
+            self._docs, self._names, self._rev = docs_map, names, rev
+            pending, self._pending = self._pending, []
+            self.ready = True
+        for op, arg in pending:
+            getattr(self, op)(arg)
+
+    def reload(self, docs):
+        """Rebuild from scratch; queries fall back to Mongo until it is ready again."""
+        with self._lock:
+            self.ready = False
+        self.load(docs)
+
+    def upsert(self, doc):
+        entry, name_keys, rev_keys = self._entry(doc)
+        entry["_name_keys"] = name_keys
+        with self._lock:
+            if not self.ready:
+                self._pending.append(("upsert", doc))
+            self._drop(doc["_id"])
+            self._docs[doc["_id"]] = entry
+            for k in name_keys:
+                bisect.insort(self._names, (k, doc["_id"]))
+            for k in rev_keys:
+                bisect.insort(self._rev, (k, doc["_id"]))
+
+    def remove(self, sid):
+        with self._lock:
+            if not self.ready:
+                self._pending.append(("remove", sid))
+            self._drop(sid)
+
+    @staticmethod
+    def _prefix_ids(arr, prefix, exact=False):
+        ids = set()
+        i = bisect.bisect_left(arr, (prefix,))
+        while i < len(arr) and arr[i][0].startswith(prefix):
+            if not exact or arr[i][0] == prefix:
+                ids.add(arr[i][1])
+            i += 1
+        return ids
+
+    def query(self, q, limit=20):
+        """Ranked student entries matching q (same semantics as search_filter)."""
+        qn = normalize(q)
+        tokens = qn.split()
+        if not tokens:
+            return []
+        with self._lock:
+            ids = None
+            for t in tokens:
+                hit = self._prefix_ids(self._names, t)
+                ids = hit if ids is None else ids & hit
+            whole = qn.replace(" ", "")
+            for tail in query_tails(whole):
+                ids |= self._prefix_ids(self._rev, tail[::-1], exact=len(tail) < MIN_SUFFIX)
+            found = [self._docs[i] for i in ids]
+        found.sort(key=lambda d: (rank(d, q), d.get("created_at") or datetime.min), reverse=True)
+        return found[:limit]
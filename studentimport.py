@@ -0,0 +1,159 @@
+import io
+import csv
+import zipfile
+from datetime import date, datetime
+
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+from bson.objectid import ObjectId
+
+# Bulk student import (CSV / XLSX). Rows are read into dicts keyed by student
+# field, checked and turned into student documents here; the app allocates
+# student_ids, inserts in chunks and updates its read models (see
+# import_students() in app.py). Course, batch and faculty columns hold names
+# (or ids) and are resolved against the cached reference data.
+
+# header (lowercased, spaces/dashes as underscores) -> student field
+COLUMNS = {
+    "form_no": "form_no", "form": "form_no", "form_number": "form_no",
+    "first_name": "first_name", "name": "first_name",
+    "father_name": "father_name", "middle_name": "father_name",
+    "last_name": "last_name", "surname": "last_name",
+    "dob": "dob", "date_of_birth": "dob",
+    "address": "address",
+    "phone": "phone", "mobile": "phone",
+    "parents_phone": "parents_phone", "parent_phone": "parents_phone",
+    "aadhar": "aadhar", "aadhaar": "aadhar",
+    "email": "email",
+    "gender": "gender",
+    "qualification": "qualification",
+    "timing": "timing",
+    "admission_date": "admission_date",
+    "payment_status": "payment_status",
+    "reference": "reference",
+    "blood_group": "blood_group",
+    "course": "course", "course_name": "course",
+    "batch": "batch", "batch_title": "batch", "batch_name": "batch",
+    "faculty": "faculty", "faculty_name": "faculty",
+}
+TEXT_FIELDS = ("first_name", "father_name", "last_name", "address", "phone", "parents_phone",
+               "aadhar", "email", "gender", "qualification", "timing", "reference", "blood_group")
+DATE_FIELDS = ("dob", "admission_date")
+REQUIRED = ("form_no", "first_name")
+
+
+def _header(name):
+    return str(name or "").strip().lower().replace(" ", "_").replace("-", "_")
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))   # spreadsheets turn phone / form numbers into floats
+    return str(value).strip()
+
+
+def _mapped(header, values):
+    row = {}
+    for name, value in zip(header, values):
+        field = COLUMNS.get(_header(name))
+        if field and field not in row:
+            row[field] = _cell(value)
+    return row
+
+
+def read_rows(filename, stream):
+    """
+    Yield (line_no, row) for every non-empty data row of a .csv or .xlsx upload.
+    line_no is the spreadsheet line (the header is line 1). Raises ValueError
+    for an unsupported file type or a missing header.
+    """
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if ext == "csv":
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    elif ext == "xlsx":
+        try:
+            wb = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+            raise ValueError(f"Could not read the XLSX file: {e}")
+        reader = wb.active.iter_rows(values_only=True)
+    else:
+        raise ValueError("Upload a .csv or .xlsx file.")
+
+    header = next(reader, None)
+    if not header or not any(COLUMNS.get(_header(h)) for h in header):
+        raise ValueError("No recognised column headers (expected e.g. form_no, first_name, course).")
+    for line_no, values in enumerate(reader, start=2):
+        row = _mapped(header, values)
+        if any(row.values()):
+            yield line_no, row
+
+
+def name_lookup(names):
+    """{normalized name: id} from a {str id: name} map; names used twice map to None."""
+    out = {}
+    for _id, name in names.items():
+        key = " ".join(str(name or "").lower().split())
+        if key:
+            out[key] = None if key in out else ObjectId(_id)
+    return out
+
+
+def _resolve(value, lookup, ids, label, errors):
+    if not value:
+        return None
+    if ObjectId.is_valid(value) and value in ids:
+        return ObjectId(value)
+    key = " ".join(value.lower().split())
+    if key not in lookup:
+        errors.append(f"unknown {label} '{value}'")
+    elif lookup[key] is None:
+        errors.append(f"{label} name '{value}' is ambiguous; use its id")
+    else:
+        return lookup[key]
+    return None
+
+
+def _iso_date(value):
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def build_student(row, refs):
+    """
+    Turn one mapped row into a student document (without student_id,
+    registration_no or search keys). refs = {"courses" | "batches" | "faculties":
+    (name lookup, {str id: name})}. Returns (doc, [errors]).
+    """
+    errors = [f"{f} is required" for f in REQUIRED if not row.get(f)]
+    doc = {f: row.get(f, "") for f in TEXT_FIELDS}
+    doc["form_no"] = row.get("form_no", "")
+    doc["payment_status"] = row.get("payment_status") or "paying"
+
+    for f in DATE_FIELDS:
+        value = row.get(f, "")
+        if value:
+            parsed = _iso_date(value)
+            if parsed is None:
+                errors.append(f"{f} '{value}' is not a date (use YYYY-MM-DD)")
+            value = parsed or ""
+        doc[f] = value   # stored as yyyy-mm-dd text, like the form's date inputs
+
+    for field, kind, label in (("course_id", "courses", "course"),
+                               ("batch_id", "batches", "batch"),
+                               ("faculty_id", "faculties", "faculty")):
+        lookup, names = refs[kind]
+        oid = _resolve(row.get(label, ""), lookup, names, label, errors)
+        if oid is not None:
+            doc[field] = oid
+    doc["faculty"] = refs["faculties"][1].get(str(doc["faculty_id"]), "") if "faculty_id" in doc else ""
+    return doc, errors
@@ -1,17 +1,90 @@
+import time
+import threading
 from bson.objectid import ObjectId
 from pymongo import ReturnDocument
 
-def get_next_sequence(db, name):
+def get_next_sequence(db, name, session=None):
     """Mongo auto-increment counter pattern"""
     res = db.counters.find_one_and_update(
         {"_id": name},
         {"$inc": {"seq": 1}},
         upsert=True,
-        return_document=ReturnDocument.AFTER
+        return_document=ReturnDocument.AFTER,
+        session=session
     )
     return res["seq"]
 
+
+def reserve_sequence(db, name, count, session=None):
+    """Reserve `count` consecutive values of a counter in one update; returns (first, last)."""
+    res = db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": int(count)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return res["seq"] - int(count) + 1, res["seq"]
+
+
+class SequenceAllocator:
+    """
+    Hi/lo allocator over db.counters. A counter with a block size above 1 is
+    reserved `block` values at a time with a single $inc and handed out from
+    memory, so only one request in `block` touches the counter document.
+    Values a worker reserved but never used (it restarted) are skipped, and
+    numbers from different workers interleave rather than following insert
+    order. Counters without a block size (or 1) take one value per round trip
+    exactly as get_next_sequence() does, which keeps them gap-free.
+    """
+
+    def __init__(self, db, blocks=None):
+        self.db = db
+        self.blocks = dict(blocks or {})
+        self._ranges = {}   # name -> [next, last] of the block held by this worker
+        self._lock = threading.Lock()
+
+    def next(self, name, session=None):
+        block = int(self.blocks.get(name, 1))
+        if block <= 1:
+            return get_next_sequence(self.db, name, session=session)
+        with self._lock:
+            held = self._ranges.get(name)
+            if not held or held[0] > held[1]:
+                held = self._ranges[name] = list(reserve_sequence(self.db, name, block))
+            value = held[0]
+            held[0] += 1
+            return value
+
 def calc_gst(amount, gst_percent):
     gst = round(amount * gst_percent / 100.0, 2)
     total = round(amount + gst, 2)
     return gst, total
+
+class TTLCache:
+    """Small thread-safe per-process cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+            self._data.pop(key, None)
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)